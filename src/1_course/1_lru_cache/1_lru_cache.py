@@ -1,30 +1,586 @@
+import asyncio
+import hashlib
+import inspect
+import io
+import os
+import pickle
+import random
+import subprocess
+import sys
+import threading
+import time
 import unittest.mock
 from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import nullcontext
 from functools import wraps
+from typing import NamedTuple
 
+try:
+    import redis
+except ImportError:  # второй уровень кэша в Redis необязателен
+    redis = None
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    coalesced: int
+    shared_hits: int
+    maxsize: int | None
+    currsize: int
+    currweight: int
+
+
+_MISSING = object()
+_KWD_MARK = object()
+_FAST_TYPES = {int, str}
+
+
+class _HashedKey(list):
+    # Хеш ключа считается один раз, а не при каждом обращении к словарю
+    __slots__ = ("hashvalue",)
+
+    def __init__(self, items: tuple):
+        self[:] = items
+        self.hashvalue = hash(items)
+
+    def __hash__(self):
+        return self.hashvalue
+
+
+def _make_key(args: tuple, kwargs: dict, typed: bool):
+    # Быстрый путь: один позиционный аргумент простого типа - сам ключ
+    if not kwargs and not typed and len(args) == 1 and type(args[0]) in _FAST_TYPES:
+        return args[0]
+
+    key = args
+    if kwargs:
+        # Порядок именованных аргументов не влияет на ключ
+        items = sorted(kwargs.items())
+        key += (_KWD_MARK, *items)
+        if typed:
+            key += tuple(type(v) for v in args) + tuple(type(v) for _, v in items)
+    elif typed:
+        key += tuple(type(v) for v in args)
+    return _HashedKey(key)
+
+
+class LRUPolicy:
+    # Вытесняет давно не использованные записи. Размер считается в единицах
+    # weigher: по умолчанию каждая запись весит 1, то есть capacity = maxsize
+    def __init__(self, capacity: int | None):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.weight = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def get(self, key):
+        item = self.data.get(key, _MISSING)
+        if item is _MISSING:
+            return _MISSING
+        self.data.move_to_end(key, last=True)
+        return item[0]
+
+    def pop(self, key) -> None:
+        _, weight = self.data.pop(key)
+        self.weight -= weight
+
+    def put(self, key, value, weight: int) -> int:
+        if key in self.data:
+            self.pop(key)
+        self.data[key] = (value, weight)
+        self.weight += weight
+
+        evicted = 0
+        if self.capacity is not None:
+            while self.weight > self.capacity:
+                _, (_, old_weight) = self.data.popitem(last=False)
+                self.weight -= old_weight
+                evicted += 1
+        return evicted
+
+    def clear(self) -> None:
+        self.data.clear()
+        self.weight = 0
+
+
+class SLRUPolicy:
+    # Сегментированный LRU: новые записи попадают в испытательный сегмент
+    # и переходят в защищённый только при повторном обращении. Однократный
+    # проход по холодным ключам вытесняет только испытательный сегмент
+    def __init__(self, capacity: int | None, protected_ratio: float = 0.8):
+        self.capacity = capacity
+        self.protected_capacity = (
+            int(capacity * protected_ratio) if capacity is not None else None
+        )
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.probation_weight = self.protected_weight = 0
+
+    @property
+    def weight(self) -> int:
+        return self.probation_weight + self.protected_weight
+
+    def __len__(self) -> int:
+        return len(self.probation) + len(self.protected)
+
+    def get(self, key):
+        item = self.protected.get(key, _MISSING)
+        if item is not _MISSING:
+            self.protected.move_to_end(key, last=True)
+            return item[0]
+
+        item = self.probation.pop(key, _MISSING)
+        if item is _MISSING:
+            return _MISSING
+
+        # Повторное обращение: переводим в защищённый сегмент, а его
+        # старые записи понижаем обратно в испытательный
+        self.probation_weight -= item[1]
+        self.protected[key] = item
+        self.protected_weight += item[1]
+        if self.protected_capacity is not None:
+            while self.protected_weight > self.protected_capacity:
+                old_key, old_item = self.protected.popitem(last=False)
+                self.protected_weight -= old_item[1]
+                self.probation[old_key] = old_item
+                self.probation_weight += old_item[1]
+        return item[0]
+
+    def pop(self, key) -> None:
+        if key in self.protected:
+            self.protected_weight -= self.protected.pop(key)[1]
+        else:
+            self.probation_weight -= self.probation.pop(key)[1]
+
+    def put(self, key, value, weight: int) -> int:
+        if key in self.protected or key in self.probation:
+            self.pop(key)
+        self.probation[key] = (value, weight)
+        self.probation_weight += weight
+
+        evicted = 0
+        if self.capacity is not None:
+            while self.weight > self.capacity:
+                if self.probation:
+                    _, (_, old_weight) = self.probation.popitem(last=False)
+                    self.probation_weight -= old_weight
+                else:
+                    _, (_, old_weight) = self.protected.popitem(last=False)
+                    self.protected_weight -= old_weight
+                evicted += 1
+        return evicted
+
+    def clear(self) -> None:
+        self.probation.clear()
+        self.protected.clear()
+        self.probation_weight = self.protected_weight = 0
+
+
+POLICIES = {"lru": LRUPolicy, "slru": SLRUPolicy}
+
+
+class _Segment:
+    # Часть кэша со своим замком: при stripes > 1 потоки с разными
+    # ключами чаще попадают в разные сегменты и не ждут друг друга.
+    # Методы get и put вызываются под self.lock
+    def __init__(self, policy, ttl: float | None, weigher, lock: bool):
+        self.policy = policy
+        self.ttl = ttl
+        self.weigher = weigher
+        self.lock = threading.Lock() if lock else nullcontext()
+        # Ключи, которые сейчас вычисляются: Future для потоков, Task для asyncio
+        self.inflight = {}
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self.coalesced = self.shared_hits = 0
+
+    def get(self, key):
+        entry = self.policy.get(key)
+        if entry is not _MISSING:
+            result, expires_at = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self.hits += 1
+                return result
+            self.policy.pop(key)
+            self.expirations += 1
+        self.misses += 1
+        return _MISSING
+
+    def put(self, key, result) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        weight = self.weigher(result) if self.weigher is not None else 1
+        self.evictions += self.policy.put(key, (result, expires_at), weight)
+
+
+class PickleSerializer:
+    name = "pickle"
+
+    def dumps(self, value) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes):
+        return pickle.loads(data)
+
+
+def _dumps_stable(value) -> bytes:
+    # Без memo: иначе байты зависят от того, один ли это объект или два
+    # равных (например, интернированная строка и собранная на лету)
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, protocol=4)
+    pickler.fast = True
+    pickler.dump(value)
+    return buffer.getvalue()
+
+
+def _canonical(value):
+    # Равные аргументы должны давать одинаковые байты в любом процессе.
+    # Порядок элементов set и frozenset зависит от рандомизации hash(),
+    # порядок dict - от порядка вставки, поэтому они сортируются. Каждый
+    # контейнер помечается типом, чтобы set и tuple с теми же элементами не
+    # совпали. Остальные объекты сериализуются как есть: их pickle не должен
+    # зависеть от процесса
+    if isinstance(value, (set, frozenset)):
+        items = sorted((_canonical(item) for item in value), key=_dumps_stable)
+        return ("set", items)
+    if isinstance(value, dict):
+        items = [(_canonical(k), _canonical(v)) for k, v in value.items()]
+        return ("dict", sorted(items, key=_dumps_stable))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, [_canonical(item) for item in value])
+    return value
+
+
+class RedisTier:
+    # Второй уровень кэша, общий для всех процессов и серверов. Первый
+    # уровень остаётся в памяти процесса, сюда идут только его промахи.
+    # Пакетные чтения и записи - один MGET и один конвейер SET на пачку.
+    # Недоступность Redis не ломает вызовы: чтение считается промахом, запись
+    # пропускается, и следующие retry_interval секунд второй уровень не
+    # используется, чтобы не ждать соединения на каждом вызове
+    def __init__(
+        self,
+        prefix: str = "lru_cache",
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        serializer=None,
+        connection_pool=None,
+        retry_interval: float = 5,
+    ):
+        if redis is None:
+            raise RuntimeError("RedisTier requires the redis package")
+        if connection_pool is not None:
+            self.r = redis.Redis(connection_pool=connection_pool)
+        else:
+            self.r = redis.Redis(host=host, port=port, db=db)
+        self.prefix = prefix
+        self.serializer = serializer or PickleSerializer()
+        self.retry_interval = retry_interval
+        self.errors = 0
+        self._down_until = 0.0
+
+    def _available(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def _failed(self) -> None:
+        self.errors += 1
+        self._down_until = time.monotonic() + self.retry_interval
+
+    def key(self, namespace: str, args: tuple, kwargs: dict) -> str | None:
+        # hash() строк различается между процессами, поэтому ключ - дайджест
+        # сериализованных в каноническом виде аргументов. Для аргументов,
+        # которые не сериализуются (замок, сокет), ключа нет: такой вызов
+        # кэшируется только в первом уровне
+        try:
+            data = _dumps_stable(_canonical((args, kwargs)))
+        except Exception:
+            return None
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return f"{self.prefix}:{namespace}:{digest}"
+
+    def get_many(self, keys: list[str | None]) -> list:
+        present = [key for key in keys if key is not None]
+        if not present or not self._available():
+            return [_MISSING] * len(keys)
+        try:
+            found = iter(self.r.mget(present))
+        except redis.RedisError:
+            self._failed()
+            return [_MISSING] * len(keys)
+        results = []
+        for key in keys:
+            data = None if key is None else next(found)
+            results.append(_MISSING if data is None else self.serializer.loads(data))
+        return results
+
+    def set_many(self, items: dict, ttl: float | None = None) -> None:
+        if not items or not self._available():
+            return
+        data = {}
+        for key, value in items.items():
+            if key is None:
+                continue
+            try:
+                data[key] = self.serializer.dumps(value)
+            except Exception:
+                # Результат не сериализуется - он остаётся только в первом уровне
+                continue
+        if not data:
+            return
+        try:
+            if ttl is None:
+                self.r.mset(data)
+                return
+            # PX 0 Redis отвергает: ttl меньше миллисекунды округляется вверх
+            px = max(1, int(ttl * 1000))
+            with self.r.pipeline(transaction=False) as pipe:
+                for key, value in data.items():
+                    pipe.set(key, value, px=px)
+                pipe.execute()
+        except redis.RedisError:
+            self._failed()
+
+    def delete(self, keys: list[str | None]) -> None:
+        keys = [key for key in keys if key is not None]
+        if keys:
+            self.r.unlink(*keys)
+
+    def clear(self, namespace: str) -> None:
+        batch = []
+        for key in self.r.scan_iter(f"{self.prefix}:{namespace}:*", count=1000):
+            batch.append(key)
+            if len(batch) >= 1000:
+                self.r.unlink(*batch)
+                batch.clear()
+        self.delete(batch)
+
+
+def lru_cache(
+    func=None,
+    *,
+    maxsize: int | None = None,
+    typed: bool = False,
+    ttl: float | None = None,
+    lock: bool = True,
+    stripes: int = 1,
+    policy="lru",
+    weigher=None,
+    shared: RedisTier | None = None,
+):
+    # policy - имя из POLICIES или фабрика policy(capacity). С weigher
+    # maxsize задаёт бюджет в его единицах (например, байтах), а не число записей.
+    # shared - второй уровень, общий для процессов; ttl действует и на нём
+    policy_factory = POLICIES[policy] if isinstance(policy, str) else policy
 
-def lru_cache(func=None, *, maxsize=None):
     def decorator(wrapped):
-        cache = OrderedDict()
+        capacity = maxsize
+        if maxsize is not None and stripes > 1:
+            capacity = -(-maxsize // stripes)
+        segments = [
+            _Segment(policy_factory(capacity), ttl, weigher, lock)
+            for _ in range(stripes)
+        ]
+
+        if shared is not None:
+            namespace = f"{wrapped.__module__}.{wrapped.__qualname__}"
+
+        def segment_for(key) -> _Segment:
+            return segments[hash(key) % stripes] if stripes > 1 else segments[0]
+
+        def load(segment: _Segment, args, kwargs):
+            if shared is None:
+                return wrapped(*args, **kwargs)
+
+            shared_key = shared.key(namespace, args, kwargs)
+            [result] = shared.get_many([shared_key])
+            if result is not _MISSING:
+                with segment.lock:
+                    segment.shared_hits += 1
+                return result
+
+            result = wrapped(*args, **kwargs)
+            shared.set_many({shared_key: result}, ttl)
+            return result
 
         @wraps(wrapped)
         def wrapper(*args, **kwargs):
-            key = (args, tuple(kwargs.items()))
+            key = _make_key(args, kwargs, typed)
+            segment = segment_for(key)
 
-            if key in cache:
-                cache.move_to_end(key, last=True)
-                return cache[key]
+            with segment.lock:
+                result = segment.get(key)
+                if result is not _MISSING:
+                    return result
 
-            result = wrapped(*args, **kwargs)
-            cache[key] = result
-            cache.move_to_end(key, last=True)
+                # Одновременные промахи по одному ключу ждут первое вычисление
+                call = segment.inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = segment.inflight[key] = Future()
+                else:
+                    segment.coalesced += 1
+
+            if not leader:
+                return call.result()
+
+            # Функция вызывается без замка: долгие и рекурсивные вызовы
+            # не блокируют остальные ключи
+            try:
+                result = load(segment, args, kwargs)
+            except BaseException as exc:
+                with segment.lock:
+                    del segment.inflight[key]
+                call.set_exception(exc)
+                raise
+
+            with segment.lock:
+                segment.put(key, result)
+                del segment.inflight[key]
+            call.set_result(result)
+            return result
 
-            if maxsize is not None and len(cache) > maxsize:
-                cache.popitem(last=False)
+        async def compute(segment: _Segment, key, args, kwargs):
+            try:
+                result = _MISSING
+                if shared is not None:
+                    # Клиент Redis синхронный - не блокируем им цикл событий
+                    shared_key = shared.key(namespace, args, kwargs)
+                    [result] = await asyncio.to_thread(shared.get_many, [shared_key])
+                if result is not _MISSING:
+                    with segment.lock:
+                        segment.shared_hits += 1
+                else:
+                    result = await wrapped(*args, **kwargs)
+                    if shared is not None:
+                        await asyncio.to_thread(
+                            shared.set_many, {shared_key: result}, ttl
+                        )
+            except BaseException:
+                with segment.lock:
+                    del segment.inflight[key]
+                raise
 
+            with segment.lock:
+                segment.put(key, result)
+                del segment.inflight[key]
             return result
 
-        return wrapper
+        @wraps(wrapped)
+        async def async_wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs, typed)
+            segment = segment_for(key)
+
+            with segment.lock:
+                result = segment.get(key)
+                if result is not _MISSING:
+                    return result
+
+                task = segment.inflight.get(key)
+                if task is not None:
+                    segment.coalesced += 1
+                else:
+                    task = asyncio.ensure_future(compute(segment, key, args, kwargs))
+                    segment.inflight[key] = task
+
+            # Кэшируется результат корутины, а не сам объект корутины. Отмена
+            # одного из ожидающих не отменяет общее вычисление
+            return await asyncio.shield(task)
+
+        def cache_info() -> CacheInfo:
+            # Встроенный sum в модуле перекрыт примером ниже
+            hits = misses = evictions = expirations = coalesced = shared_hits = 0
+            currsize = currweight = 0
+            for segment in segments:
+                hits += segment.hits
+                misses += segment.misses
+                evictions += segment.evictions
+                expirations += segment.expirations
+                coalesced += segment.coalesced
+                shared_hits += segment.shared_hits
+                currsize += len(segment.policy)
+                currweight += segment.policy.weight
+            return CacheInfo(
+                hits,
+                misses,
+                evictions,
+                expirations,
+                coalesced,
+                shared_hits,
+                maxsize,
+                currsize,
+                currweight,
+            )
+
+        def cache_map(iterable) -> list:
+            # Пакетный вариант для функций одного аргумента: промахи первого
+            # уровня читаются одним MGET, новые результаты пишутся одним конвейером
+            items = list(iterable)
+            results, missing = [], []
+            for i, item in enumerate(items):
+                key = _make_key((item,), {}, typed)
+                segment = segment_for(key)
+                with segment.lock:
+                    results.append(segment.get(key))
+                if results[i] is _MISSING:
+                    missing.append((i, key, segment))
+
+            shared_keys = {}
+            if shared is not None and missing:
+                shared_keys = {
+                    i: shared.key(namespace, (items[i],), {}) for i, *_ in missing
+                }
+                found = shared.get_many(list(shared_keys.values()))
+                for (i, key, segment), result in zip(missing, found):
+                    if result is not _MISSING:
+                        results[i] = result
+                        with segment.lock:
+                            segment.shared_hits += 1
+                            segment.put(key, result)
+
+            computed = {}
+            for i, key, segment in missing:
+                if results[i] is _MISSING:
+                    results[i] = wrapped(items[i])
+                    with segment.lock:
+                        segment.put(key, results[i])
+                    if shared is not None:
+                        computed[shared_keys[i]] = results[i]
+            if computed:
+                shared.set_many(computed, ttl)
+            return results
+
+        def cache_invalidate(*args, **kwargs) -> None:
+            key = _make_key(args, kwargs, typed)
+            segment = segment_for(key)
+            with segment.lock:
+                if segment.policy.get(key) is not _MISSING:
+                    segment.policy.pop(key)
+            # Копии в первом уровне других процессов доживают свой ttl
+            if shared is not None:
+                shared.delete([shared.key(namespace, args, kwargs)])
+
+        def cache_clear(shared_tier: bool = False) -> None:
+            for segment in segments:
+                with segment.lock:
+                    segment.policy.clear()
+                    segment.hits = segment.misses = 0
+                    segment.evictions = segment.expirations = 0
+                    segment.coalesced = segment.shared_hits = 0
+            if shared_tier and shared is not None:
+                shared.clear(namespace)
+
+        decorated = async_wrapper if inspect.iscoroutinefunction(wrapped) else wrapper
+        decorated.cache_info = cache_info
+        decorated.cache_clear = cache_clear
+        decorated.cache_invalidate = cache_invalidate
+        if decorated is wrapper:
+            decorated.cache_map = cache_map
+        return decorated
 
     if func is not None:
         return decorator(func)
@@ -47,7 +603,43 @@ def multiply(a: int, b: int) -> int:
     return a * b
 
 
+def make_trace(n=200_000, hot_keys=2_000, scan_every=20_000, scan_size=5_000):
+    # Обращения к горячим ключам по закону Ципфа, перемежаемые однократными
+    # проходами по холодным ключам (как отчёт или прогрев соседнего сервиса)
+    rng = random.Random(42)
+    weights = [1 / (i + 1) for i in range(hot_keys)]
+    trace = []
+    scan_start = hot_keys
+    while len(trace) < n:
+        trace.extend(rng.choices(range(hot_keys), weights, k=scan_every))
+        if scan_size:
+            trace.extend(range(scan_start, scan_start + scan_size))
+            scan_start += scan_size
+    return trace[:n]
+
+
+def benchmark_policies(maxsize=500):
+    traces = {"zipf": make_trace(scan_size=0), "zipf+scan": make_trace()}
+    for trace_name, trace in traces.items():
+        for policy in POLICIES:
+            cached = lru_cache(maxsize=maxsize, policy=policy)(lambda key: key)
+
+            start = time.perf_counter()
+            for key in trace:
+                cached(key)
+            elapsed = time.perf_counter() - start
+
+            info = cached.cache_info()
+            print(
+                f"{trace_name:<10} {policy:<5} "
+                f"hit ratio {info.hits / len(trace):6.1%}  "
+                f"{len(trace) / elapsed:10.0f} ops/s"
+            )
+
+
 if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
     assert sum(1, 2) == 3
     assert sum(3, 4) == 7
 
@@ -68,3 +660,197 @@ if __name__ == "__main__":
     assert decorated(5, 6) == 3
     assert decorated(1, 2) == 4
     assert mocked_func.call_count == 4
+
+    info = decorated.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.currsize) == (3, 4, 2, 2)
+
+    decorated.cache_clear()
+    assert decorated.cache_info() == (0, 0, 0, 0, 0, 0, 2, 0, 0)
+
+    # Порядок именованных аргументов не создаёт новую запись
+    assert sum_many(1, 2, d=4, c=3) == 10
+    assert sum_many.cache_info().currsize == 1
+
+    # typed=True разделяет 1 и 1.0
+    typed_func = lru_cache(typed=True)(unittest.mock.Mock(side_effect=[1, 2]))
+    assert typed_func(1) == 1
+    assert typed_func(1.0) == 2
+
+    # Запись с истёкшим TTL вычисляется заново
+    ttl_func = lru_cache(ttl=0.1)(unittest.mock.Mock(side_effect=[1, 2]))
+    assert ttl_func("a") == 1
+    assert ttl_func("a") == 1
+    time.sleep(0.15)
+    assert ttl_func("a") == 2
+    assert ttl_func.cache_info().expirations == 1
+
+    # Конкурентные вызовы из пула потоков не ломают кэш и не превышают maxsize
+    for stripes in (1, 8):
+
+        @lru_cache(maxsize=64, stripes=stripes)
+        def square(x: int) -> int:
+            return x * x
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            keys = [i % 200 for i in range(20_000)]
+            assert list(executor.map(square, keys)) == [k * k for k in keys]
+
+        info = square.cache_info()
+        assert info.hits + info.misses == 20_000
+        assert info.currsize <= 64
+        assert info.evictions <= info.misses - info.currsize
+
+    # Промах по популярному ключу вычисляется один раз, остальные ждут
+    slow_calls = []
+
+    @lru_cache(maxsize=16)
+    def slow(x: int) -> int:
+        slow_calls.append(x)
+        time.sleep(0.2)
+        return x
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(executor.map(slow, [1] * 8)) == [1] * 8
+    assert slow_calls == [1]
+    assert slow.cache_info().coalesced == 7
+
+    # Ошибка передаётся всем ожидающим и не кэшируется
+    failing = lru_cache(unittest.mock.Mock(side_effect=[ValueError, 5]))
+    try:
+        failing(1)
+    except ValueError:
+        pass
+    assert failing(1) == 5
+
+    async def check_async():
+        calls = []
+
+        @lru_cache(maxsize=2, ttl=0.2)
+        async def fetch(x: int) -> int:
+            calls.append(x)
+            await asyncio.sleep(0.1)
+            return x * 10
+
+        assert await asyncio.gather(*(fetch(1) for _ in range(10))) == [10] * 10
+        assert await fetch(1) == 10
+        assert calls == [1]
+
+        # Отмена одного ожидающего не ломает остальных
+        first = asyncio.ensure_future(fetch(2))
+        second = asyncio.ensure_future(fetch(2))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == 20
+
+        await fetch(3)
+        assert fetch.cache_info().currsize == 2
+        assert fetch.cache_info().evictions == 1
+
+        await asyncio.sleep(0.25)
+        assert await fetch(3) == 30
+        assert calls == [1, 2, 3, 3]
+
+    asyncio.run(check_async())
+
+    # Бюджет в байтах: запись крупнее оставшегося места вытесняет старые
+    sized = lru_cache(maxsize=100, weigher=len)(lambda n: b"x" * n)
+    sized(40)
+    sized(40)
+    sized(30)
+    assert sized.cache_info().currsize == 2
+    assert sized.cache_info().currweight == 70
+
+    # SLRU: проход по холодным ключам не вытесняет повторно используемые
+    for policy, survives in (("lru", False), ("slru", True)):
+        calls = []
+        cached = lru_cache(maxsize=10, policy=policy)(calls.append)
+        for key in ("hot", "hot", *range(20), "hot"):
+            cached(key)
+        assert (calls.count("hot") == 1) is survives
+
+    # Недоступный Redis: функция просто вычисляется
+    if redis is not None:
+        offline_tier = RedisTier(port=1, retry_interval=60)
+
+        @lru_cache(shared=offline_tier)
+        def offline(x: int) -> int:
+            return x * 2
+
+        assert offline(3) == 6 and offline(4) == 8 and offline.cache_map([5]) == [10]
+        # После первой ошибки Redis не дёргается до конца retry_interval
+        assert offline_tier.errors == 1
+
+    # Ключ второго уровня одинаков в процессах с разной рандомизацией hash()
+    if redis is not None:
+        code = (
+            "import importlib; module = importlib.import_module('1_lru_cache')"
+            "; tier = module.RedisTier()"
+            "; print(tier.key('ns', (frozenset('abcdefgh'), {'x', 'y'}), "
+            "{'b': {3, 4}, 'a': [''.join(['s', 't'])]}))"
+        )
+        digests = {
+            subprocess.run(
+                [sys.executable, "-c", code],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env={**os.environ, "PYTHONHASHSEED": str(seed)},
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            for seed in range(6)
+        }
+        assert len(digests) == 1, digests
+        tier = RedisTier()
+        assert tier.key("ns", ({1, 2},), {}) != tier.key("ns", ((1, 2),), {})
+
+    # Второй уровень в Redis: процессы пула используют результаты друг друга
+    if redis is not None:
+        from multiprocessing import Pool
+
+        tier = RedisTier(prefix="lru_cache_test")
+        try:
+            tier.r.ping()
+        except redis.ConnectionError:
+            tier = None
+
+    if redis is not None and tier is not None:
+        tier.r.delete("lru_cache_test:computed")
+
+        @lru_cache(maxsize=1000, ttl=60, shared=tier)
+        def shared_square(x: int) -> int:
+            tier.r.incr("lru_cache_test:computed")
+            return x * x
+
+        shared_square.cache_clear(shared_tier=True)
+        with Pool(4) as pool:
+            keys = list(range(100)) * 4
+            assert pool.map(shared_square, keys, chunksize=25) == [k * k for k in keys]
+        assert int(tier.r.get("lru_cache_test:computed")) < 200
+
+        # Пакетное чтение: всё уже лежит во втором уровне
+        assert shared_square.cache_map(range(100)) == [k * k for k in range(100)]
+        assert shared_square.cache_info().shared_hits == 100
+
+        # Несериализуемые аргументы и результаты минуют второй уровень
+        @lru_cache(shared=tier)
+        def make_lock(owner) -> threading.Lock:
+            return threading.Lock()
+
+        assert make_lock("a") is make_lock("a")
+        owner = threading.Lock()
+        assert make_lock(owner) is make_lock(owner)
+
+        # ttl короче миллисекунды не выключает второй уровень
+        @lru_cache(ttl=0.0005, shared=tier)
+        def short_lived(x: int) -> int:
+            return x
+
+        assert short_lived(1) == 1 and tier.errors == 0
+
+        shared_square.cache_invalidate(5)
+        assert not tier.r.exists(tier.key(f"{__name__}.shared_square", (5,), {}))
+        shared_square.cache_clear(shared_tier=True)
+        assert not list(tier.r.scan_iter("lru_cache_test:*shared_square*"))
+        tier.r.delete("lru_cache_test:computed")
+
+    benchmark_policies()
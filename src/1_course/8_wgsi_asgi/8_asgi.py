@@ -1,99 +1,358 @@
 # Запуск:
 #   uvicorn 8_asgi:app --host 127.0.0.1 --port 8000
+# Адрес апстрима можно подменить: CURRENCY_UPSTREAM=http://127.0.0.1:9000
+# Сроки кэша - CURRENCY_CACHE_TTL и CURRENCY_STALE_TTL (0 - без кэша)
 # Тест:
 #   curl -i http://127.0.0.1:8000/USD
+#   python 8_asgi.py --self-test
 
 import asyncio
 import json
-import re
+import sys
+import time
 
 import aiohttp
+from routing import (
+    CACHE_TTL,
+    GATEWAY_TIMEOUT,
+    INTERNAL_ERROR,
+    STALE_TTL,
+    UNSUPPORTED_SCOPE,
+    UPSTREAM_UNAVAILABLE,
+    CacheEntry,
+    Response,
+    cache_entry,
+    cache_headers,
+    error_response,
+    etag_matches,
+    json_response,
+    route,
+)
+from upstream import (
+    HEDGE_AFTER,
+    UPSTREAM,
+    UPSTREAM_CONCURRENCY,
+    UPSTREAM_TIMEOUT,
+    CircuitBreaker,
+    UpstreamError,
+    UpstreamGuard,
+    UpstreamUnavailable,
+    is_upstream_failure,
+)
 
-PROVIDER = "https://www.exchangerate-api.com"
-
-
-async def send_json_error(send, status: int, message: str):
-    body = json.dumps({"error": message}).encode("utf-8")
-    headers = [
-        (b"content-type", b"application/json; charset=utf-8"),
-        (b"content-length", str(len(body)).encode("ascii")),
-        (b"cache-control", b"no-store"),
-        (b"access-control-allow-origin", b"*"),
-    ]
-    await send({"type": "http.response.start", "status": status, "headers": headers})
-    await send({"type": "http.response.body", "body": body, "more_body": False})
-
-
-def parse_currency(path: str) -> str | None:
-    currency = path.strip("/")
-    if not re.fullmatch(r"[A-Za-z]{3}", currency or ""):
-        return None
-    return currency.upper()
-
-
-async def app(scope, receive, send):
-    if scope["type"] != "http":
-        await send_json_error(send, 404, "Unsupported scope type")
-        return
-
-    method: str = scope.get("method", "GET").upper()
-    path: str = scope.get("path", "/")
-
-    if path == "/favicon.ico":
-        await send({"type": "http.response.start", "status": 204, "headers": []})
-        await send({"type": "http.response.body", "body": b"", "more_body": False})
-        return
-
-    if method not in ("GET", "HEAD"):
-        await send_json_error(send, 405, "Method Not Allowed (use GET/HEAD)")
-        return
-
-    currency = parse_currency(path)
-    if not currency:
-        await send_json_error(send, 400, "Usage: GET /USD (3-letter currency code)")
-        return
-
-    upstream_url = f"https://api.exchangerate-api.com/v4/latest/{currency}"
-
-    timeout = aiohttp.ClientTimeout(total=10)
-    try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(
-                upstream_url, headers={"Accept": "application/json"}
-            ) as resp:
-                headers = [
-                    (b"content-type", b"application/json; charset=utf-8"),
-                    (b"cache-control", b"no-store"),
-                    (b"access-control-allow-origin", b"*"),
-                    (b"x-proxy-provider", PROVIDER.encode("ascii")),
-                ]
-
-                await send(
-                    {
-                        "type": "http.response.start",
-                        "status": resp.status,
-                        "headers": headers,
-                    }
-                )
-
-                if method == "HEAD":
-                    await send(
-                        {"type": "http.response.body", "body": b"", "more_body": False}
-                    )
-                    return
-
-                async for chunk in resp.content.iter_chunked(64 * 1024):
-                    await send(
-                        {"type": "http.response.body", "body": chunk, "more_body": True}
-                    )
-
-                await send(
-                    {"type": "http.response.body", "body": b"", "more_body": False}
-                )
-
-    except asyncio.TimeoutError:
-        await send_json_error(send, 504, "Upstream timeout")
-    except aiohttp.ClientError as e:
-        await send_json_error(send, 502, f"Bad Gateway: {e.__class__.__name__}")
-    except Exception:
-        await send_json_error(send, 500, "Internal Server Error")
+
+class RatesCache:
+    # Кэш ответов апстрима по валюте поверх одной общей ClientSession.
+    # Одновременные промахи по валюте ждут один запрос к апстриму, устаревшая
+    # запись отдаётся сразу и обновляется условным запросом в фоне. Пока
+    # апстрим недоступен, отдаётся последняя запись, даже просроченная
+    def __init__(
+        self,
+        upstream: str = UPSTREAM,
+        ttl: float = CACHE_TTL,
+        stale_ttl: float = STALE_TTL,
+        timeout: float = 10,
+        guard: UpstreamGuard | None = None,
+    ):
+        self.upstream = upstream
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.guard = guard or UpstreamGuard(
+            upstream.split("://")[-1],
+            max_concurrency=UPSTREAM_CONCURRENCY,
+            timeout=UPSTREAM_TIMEOUT,
+            hedge_after=HEDGE_AFTER,
+            is_failure=is_upstream_failure,
+        )
+        self.session: aiohttp.ClientSession | None = None
+        self._entries: dict[str, CacheEntry] = {}
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    async def open(self) -> None:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                base_url=self.upstream,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+                headers={"Accept": "application/json"},
+            )
+
+    async def close(self) -> None:
+        for task in list(self._inflight.values()):
+            task.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, currency: str) -> CacheEntry:
+        entry = self._entries.get(currency)
+        if entry is not None:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                return entry
+            if age < self.ttl + self.stale_ttl:
+                if currency not in self._inflight:
+                    self._start(currency, entry)
+                return entry
+
+        task = self._inflight.get(currency) or self._start(currency, entry)
+        # Отмена одного клиента не отменяет общий запрос к апстриму
+        try:
+            return await asyncio.shield(task)
+        except Exception as e:
+            if entry is None or not is_upstream_failure(e):
+                raise
+            return entry
+
+    def _start(self, currency: str, entry: CacheEntry | None) -> asyncio.Task:
+        task = asyncio.ensure_future(self._load(currency, entry))
+        self._inflight[currency] = task
+        task.add_done_callback(lambda task: self._done(currency, task))
+        return task
+
+    def _done(self, currency: str, task: asyncio.Task) -> None:
+        self._inflight.pop(currency, None)
+        # Ошибку фонового обновления никто не ждёт - забираем её, чтобы
+        # не было предупреждения; устаревшая запись остаётся в кэше
+        if not task.cancelled():
+            task.exception()
+
+    async def _load(self, currency: str, entry: CacheEntry | None) -> CacheEntry:
+        # Без lifespan (например, в тестах) сессия создаётся при первом запросе
+        await self.open()
+
+        headers = {}
+        if entry is not None and entry.upstream_etag:
+            headers["If-None-Match"] = entry.upstream_etag
+
+        async def fetch():
+            path = f"/v4/latest/{currency}"
+            async with self.session.get(path, headers=headers) as resp:
+                body = await resp.read()
+                if resp.status not in (200, 304):
+                    raise UpstreamError(resp.status, body)
+                return resp.status, resp.headers.get("ETag"), body
+
+        status, upstream_etag, body = await self.guard.acall(fetch)
+        if status == 304 and entry is not None:
+            entry = entry._replace(fetched_at=time.monotonic())
+        elif status == 200:
+            entry = cache_entry(body, upstream_etag)
+        else:
+            raise UpstreamError(status, body)
+
+        self._entries[currency] = entry
+        return entry
+
+
+async def respond(send, response: Response):
+    await send(response.asgi_start)
+    await send(response.asgi_body)
+
+
+async def lifespan(cache: RatesCache, receive, send):
+    # Одна сессия (пул соединений, DNS-кэш, TLS-сессии) на весь процесс
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await cache.open()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await cache.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def make_app(cache: RatesCache):
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(cache, receive, send)
+            return
+
+        if scope["type"] != "http":
+            await respond(send, UNSUPPORTED_SCOPE)
+            return
+
+        method: str = scope.get("method", "GET")
+        currency = route(method, scope.get("path", "/"))
+        if not isinstance(currency, str):
+            await respond(send, currency)
+            return
+
+        try:
+            entry = await cache.get(currency)
+        except UpstreamError as e:
+            body = e.body or json.dumps(
+                {"error": f"Upstream HTTPError: {e.status}"}
+            ).encode("utf-8")
+            await respond(send, json_response(e.status, body))
+            return
+        except UpstreamUnavailable:
+            await respond(send, UPSTREAM_UNAVAILABLE)
+            return
+        except asyncio.TimeoutError:
+            await respond(send, GATEWAY_TIMEOUT)
+            return
+        except aiohttp.ClientError as e:
+            await respond(
+                send, error_response(502, f"Bad Gateway: {e.__class__.__name__}")
+            )
+            return
+        except Exception:
+            await respond(send, INTERNAL_ERROR)
+            return
+
+        headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in cache_headers(entry, cache.ttl, cache.stale_ttl)
+        ]
+
+        status, body = 200, entry.body
+        if_none_match = dict(scope.get("headers", [])).get(b"if-none-match")
+        if if_none_match and etag_matches(if_none_match.decode("latin-1"), entry.etag):
+            status, body = 304, b""
+        else:
+            headers += [
+                (b"content-type", b"application/json; charset=utf-8"),
+                (b"content-length", str(len(body)).encode("ascii")),
+            ]
+            if method == "HEAD":
+                body = b""
+
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": body, "more_body": False})
+
+    return app
+
+
+app = make_app(RatesCache())
+
+
+async def self_test():
+    from stub_upstream import StubUpstream
+
+    async def call(app, path, headers=None):
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "headers": [
+                (k.lower().encode("latin-1"), v.encode("latin-1"))
+                for k, v in (headers or {}).items()
+            ],
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        await app(scope, receive, send)
+        start, *body = messages
+        return (
+            start["status"],
+            dict(start["headers"]),
+            b"".join(m["body"] for m in body),
+        )
+
+    with StubUpstream() as stub:
+        guard = UpstreamGuard(
+            "stub-asgi",
+            timeout=0.5,
+            breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60),
+            is_failure=is_upstream_failure,
+        )
+        cache = RatesCache(stub.url, ttl=0.3, stale_ttl=5, guard=guard)
+        test_app = make_app(cache)
+
+        inbox, outbox = asyncio.Queue(), asyncio.Queue()
+        lifespan_task = asyncio.ensure_future(
+            test_app({"type": "lifespan"}, inbox.get, outbox.put)
+        )
+        await inbox.put({"type": "lifespan.startup"})
+        assert (await outbox.get())["type"] == "lifespan.startup.complete"
+        session = cache.session
+
+        # Одновременные промахи по одной валюте - один запрос к апстриму
+        stub.delay = 0.2
+        results = await asyncio.gather(*(call(test_app, "/usd") for _ in range(20)))
+        assert {status for status, _, _ in results} == {200}
+        assert stub.requests == 1
+        stub.delay = 0
+
+        status, headers, body = await call(test_app, "/USD")
+        assert json.loads(body)["base"] == "USD" and stub.requests == 1
+        etag = headers[b"etag"].decode("ascii")
+        assert b"max-age=" in headers[b"cache-control"]
+
+        status, _, body = await call(test_app, "/USD", {"If-None-Match": etag})
+        assert status == 304 and body == b""
+
+        # Устаревшая запись отдаётся сразу, обновление идёт в фоне через ту же
+        # сессию и то же keep-alive соединение
+        await asyncio.sleep(0.35)
+        stub.delay = 0.2
+        start = time.perf_counter()
+        status, _, _ = await call(test_app, "/USD")
+        assert status == 200 and time.perf_counter() - start < 0.1
+        await asyncio.sleep(0.3)
+        assert stub.requests == 2 and stub.not_modified == 1
+        assert stub.connections == 1
+        stub.delay = 0
+
+        # Ошибки апстрима не кэшируются
+        requests = stub.requests
+        for _ in range(2):
+            status, headers, _ = await call(test_app, "/CHF")
+            assert status == 404 and headers[b"cache-control"] == b"no-store"
+        assert stub.requests == requests + 2
+
+        # Неизвестный код и неверный формат отвечаются без апстрима
+        assert (await call(test_app, "/XXX"))[0] == 404
+        assert (await call(test_app, "/US1"))[0] == 400
+        assert stub.requests == requests + 2
+        assert cache.session is session
+        assert guard.breaker.failures == 0
+
+        # Медленный апстрим: ответ 504 по бюджету, а не по таймауту сессии
+        stub.delay = 1.0
+        start = time.perf_counter()
+        assert (await call(test_app, "/JPY"))[0] == 504
+        assert time.perf_counter() - start < 0.8
+        stub.delay = 0
+
+        # Апстрим болеет: просроченная запись отдаётся вместо ошибки
+        stub.fail_status = 503
+        cache.stale_ttl = 0
+        await asyncio.sleep(0.35)
+        status, _, body = await call(test_app, "/USD")
+        assert status == 200 and json.loads(body)["base"] == "USD"
+        assert (await call(test_app, "/EUR"))[0] == 503
+        assert guard.breaker.state == "open"
+
+        # Автомат открыт: без записи в кэше - сразу 503, апстрим не трогаем
+        requests = stub.requests
+        status, _, body = await call(test_app, "/GBP")
+        assert status == 503 and "unavailable" in json.loads(body)["error"]
+        assert (await call(test_app, "/USD"))[0] == 200
+        assert stub.requests == requests and guard.rejected == 2
+        stub.fail_status = None
+
+        await inbox.put({"type": "lifespan.shutdown"})
+        assert (await outbox.get())["type"] == "lifespan.shutdown.complete"
+        await lifespan_task
+        assert session.closed and cache.session is None
+
+    print("self-test passed")
+
+
+if __name__ == "__main__":
+    if "--self-test" in sys.argv:
+        asyncio.run(self_test())
+    else:
+        print("Run with: uvicorn 8_asgi:app --host 127.0.0.1 --port 8000")
@@ -1,139 +1,483 @@
 # Запуск:
-#   python wsgi_currency_proxy.py
+#   python 8_wsgi.py                              # один поток (wsgiref)
+#   python 8_wsgi.py --mode threaded              # поток на запрос
+#   python 8_wsgi.py --mode prefork --workers 4   # процессы на общем сокете
+# Адрес апстрима можно подменить: CURRENCY_UPSTREAM=http://127.0.0.1:9000
+# Сроки кэша - CURRENCY_CACHE_TTL и CURRENCY_STALE_TTL (0 - без кэша)
 # Тест:
 #   curl -i http://127.0.0.1:8000/USD
+#   python 8_wsgi.py --self-test
 
+import argparse
+import http.client
 import json
-import re
-import urllib.error
-import urllib.request
-from http import HTTPStatus
-from wsgiref.simple_server import make_server
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
 
-PROVIDER = "https://www.exchangerate-api.com"
+from routing import (
+    CACHE_TTL,
+    GATEWAY_TIMEOUT,
+    INTERNAL_ERROR,
+    STALE_TTL,
+    UPSTREAM_UNAVAILABLE,
+    CacheEntry,
+    Response,
+    cache_entry,
+    cache_headers,
+    error_response,
+    etag_matches,
+    json_response,
+    route,
+    status_line,
+)
+from upstream import (
+    HEDGE_AFTER,
+    UPSTREAM,
+    UPSTREAM_CONCURRENCY,
+    UPSTREAM_TIMEOUT,
+    CircuitBreaker,
+    UpstreamError,
+    UpstreamGuard,
+    UpstreamUnavailable,
+    is_upstream_failure,
+)
 
 
-def _http_status_line(status_code: int) -> str:
-    try:
-        reason = HTTPStatus(status_code).phrase
-    except Exception:
-        reason = "OK"
-    return f"{status_code} {reason}"
+class ConnectionPool:
+    # Keep-alive соединения к апстриму: TCP и TLS-рукопожатие выполняются
+    # один раз на соединение, а не на каждый запрос
+    def __init__(self, base_url: str, maxsize: int = 10, timeout: float = 10):
+        parts = urlsplit(base_url)
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize)
 
+    def _get(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+            return conn, False
 
-def _bad_request(start_response, message: str):
-    body = json.dumps({"error": message}).encode("utf-8")
-    start_response(
-        _http_status_line(400),
-        [
-            ("Content-Type", "application/json; charset=utf-8"),
-            ("Content-Length", str(len(body))),
-            ("Cache-Control", "no-store"),
-        ],
-    )
-    return [body]
+    def _put(self, conn) -> None:
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
+    def request(self, method: str, path: str, headers: dict | None = None):
+        while True:
+            conn, reused = self._get()
+            try:
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+                body = resp.read()
+            except (ConnectionError, http.client.HTTPException):
+                conn.close()
+                # Апстрим мог закрыть простаивавшее соединение - повторяем
+                # на новом, ошибку нового соединения отдаём наверх
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
 
-def not_found(start_response, message: str = "Not found"):
-    body = json.dumps({"error": message}).encode("utf-8")
-    start_response(
-        _http_status_line(404),
-        [
-            ("Content-Type", "application/json; charset=utf-8"),
-            ("Content-Length", str(len(body))),
-            ("Cache-Control", "no-store"),
-        ],
-    )
-    return [body]
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put(conn)
+            return resp.status, resp.headers, body
 
 
-def _error(start_response, status: int, message: str):
-    body = json.dumps({"error": message}).encode("utf-8")
-    start_response(
-        _http_status_line(status),
-        [
-            ("Content-Type", "application/json; charset=utf-8"),
-            ("Content-Length", str(len(body))),
-            ("Cache-Control", "no-store"),
-        ],
-    )
-    return [body]
+class RatesCache:
+    # TTL-кэш ответов апстрима по валюте со stale-while-revalidate: устаревшая
+    # запись отдаётся сразу, а обновляется одним фоновым запросом. Пока
+    # апстрим недоступен, отдаётся последняя запись, даже просроченная
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        ttl: float = CACHE_TTL,
+        stale_ttl: float = STALE_TTL,
+        guard: UpstreamGuard | None = None,
+    ):
+        self.pool = pool
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.guard = guard or UpstreamGuard(
+            pool.host,
+            max_concurrency=UPSTREAM_CONCURRENCY,
+            timeout=UPSTREAM_TIMEOUT,
+            hedge_after=HEDGE_AFTER,
+            is_failure=is_upstream_failure,
+        )
+        self._entries: dict[str, CacheEntry] = {}
+        self._lock = threading.Lock()
+        self._inflight: dict[str, Future] = {}
 
+    def get(self, currency: str) -> CacheEntry:
+        entry = self._entries.get(currency)
+        if entry is not None:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                return entry
+            if age < self.ttl + self.stale_ttl:
+                self._start(currency, entry, background=True)
+                return entry
 
-def app(environ, start_response):
-    method = environ.get("REQUEST_METHOD", "GET").upper()
-    path = environ.get("PATH_INFO", "/")
+        # Промах: одновременные запросы одной валюты ждут одну загрузку и
+        # получают её результат или ошибку. Ожидание входит в бюджет
+        future = self._start(currency, entry)
+        try:
+            return future.result(timeout=self.guard.timeout)
+        except Exception as e:
+            if entry is None or not is_upstream_failure(e):
+                raise
+            return entry
 
-    if path == "/favicon.ico":
-        start_response(_http_status_line(204), [])
-        return [b""]
+    def _start(
+        self, currency: str, entry: CacheEntry | None, background: bool = False
+    ) -> Future:
+        with self._lock:
+            future = self._inflight.get(currency)
+            if future is not None:
+                return future
+            future = self._inflight[currency] = Future()
 
-    if method != "GET":
-        return _error(start_response, 405, "Method Not Allowed (use GET)")
+        if background:
+            threading.Thread(
+                target=self._run, args=(currency, entry, future), daemon=True
+            ).start()
+        else:
+            self._run(currency, entry, future)
+        return future
 
-    currency = path.strip("/")
+    def _run(self, currency: str, entry: CacheEntry | None, future: Future) -> None:
+        # Ошибку фонового обновления никто не ждёт: она остаётся в future,
+        # а устаревшая запись - в кэше
+        try:
+            future.set_result(self._load(currency, entry))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._inflight[currency]
 
-    if not currency:
-        return not_found(start_response)
+    def _load(self, currency: str, entry: CacheEntry | None) -> CacheEntry:
+        headers = {
+            "User-Agent": "wsgi-currency-proxy/1.0 (+https://www.python.org/)",
+            "Accept": "application/json",
+        }
+        if entry is not None and entry.upstream_etag:
+            headers["If-None-Match"] = entry.upstream_etag
 
-    if not re.fullmatch(r"[A-Za-z]{3}", currency):
-        return _bad_request(
-            start_response, "Currency must be 3 latin letters, e.g. USD, EUR"
-        )
+        def fetch():
+            status, resp_headers, body = self.pool.request(
+                "GET", f"/v4/latest/{currency}", headers
+            )
+            if status not in (200, 304):
+                raise UpstreamError(status, body)
+            return status, resp_headers, body
 
-    currency = currency.upper()
+        status, resp_headers, body = self.guard.call(fetch)
+        if status == 304 and entry is not None:
+            entry = entry._replace(fetched_at=time.monotonic())
+        elif status == 200:
+            entry = cache_entry(body, resp_headers.get("ETag"))
+        else:
+            raise UpstreamError(status, body)
 
-    upstream_url: str = f"https://api.exchangerate-api.com/v4/latest/{currency}"
+        with self._lock:
+            self._entries[currency] = entry
+        return entry
 
-    req = urllib.request.Request(
-        upstream_url,
-        headers={
-            "User-Agent": "wsgi-currency-proxy/1.0 (+https://www.python.org/)",
-            "Accept": "application/json",
-        },
-        method="GET",
-    )
 
-    try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            status_code = resp.getcode()
-            body = resp.read()
+def make_app(cache: RatesCache):
+    def respond(start_response, response: Response):
+        start_response(response.status_line, list(response.headers))
+        return [response.body]
+
+    def app(environ, start_response):
+        method = environ.get("REQUEST_METHOD", "GET").upper()
+        currency = route(method, environ.get("PATH_INFO", "/"))
+        if not isinstance(currency, str):
+            return respond(start_response, currency)
+
+        try:
+            entry = cache.get(currency)
+
+        except UpstreamError as e:
+            err_body = e.body or json.dumps(
+                {"error": f"Upstream HTTPError: {e.status}"}
+            ).encode("utf-8")
+            return respond(start_response, json_response(e.status, err_body))
+
+        except UpstreamUnavailable:
+            return respond(start_response, UPSTREAM_UNAVAILABLE)
+
+        except TimeoutError:
+            return respond(start_response, GATEWAY_TIMEOUT)
+
+        except (OSError, http.client.HTTPException) as e:
+            return respond(start_response, error_response(502, f"Bad Gateway: {e}"))
+
+        except Exception:
+            return respond(start_response, INTERNAL_ERROR)
 
-            headers = [
-                ("Content-Type", "application/json; charset=utf-8"),
-                ("Content-Length", str(len(body))),
-                ("Cache-Control", "no-store"),
-                ("Access-Control-Allow-Origin", "*"),
-                ("Access-Control-Expose-Headers", "Content-Type"),
-                ("X-Proxy-Provider", PROVIDER),
-            ]
-
-            start_response(_http_status_line(status_code), headers)
-            return [body]
-
-    except urllib.error.HTTPError as e:
-        err_body = e.read() or json.dumps(
-            {"error": f"Upstream HTTPError: {e.code}"}
-        ).encode("utf-8")
-        headers = [
+        headers = cache_headers(entry, cache.ttl, cache.stale_ttl)
+
+        if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+        if if_none_match and etag_matches(if_none_match, entry.etag):
+            start_response(status_line(304), headers)
+            return [b""]
+
+        headers += [
             ("Content-Type", "application/json; charset=utf-8"),
-            ("Content-Length", str(len(err_body))),
-            ("Cache-Control", "no-store"),
-            ("X-Proxy-Provider", PROVIDER),
+            ("Content-Length", str(len(entry.body))),
         ]
-        start_response(_http_status_line(e.code), headers)
-        return [err_body]
+        start_response(status_line(200), headers)
+        return [b""] if method == "HEAD" else [entry.body]
 
-    except urllib.error.URLError as e:
-        return _error(start_response, 502, f"Bad Gateway: {e.reason}")
+    return app
 
-    except Exception as e:
-        return _error(start_response, 500, f"Internal Server Error: {e}")
 
-if __name__ == "__main__":
-    with make_server("127.0.0.1", 8000, app) as server:
-        print("Serving on http://127.0.0.1:8000 (Ctrl+C to stop)")
+app = make_app(RatesCache(ConnectionPool(UPSTREAM)))
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # Очередь listen() по умолчанию - 5 соединений: при всплеске подключений
+    # ядро отбрасывает SYN, и клиент повторяет его только через секунду
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(app, host: str, port: int, mode: str = "simple", workers: int = 4):
+    server_class = WSGIServer if mode == "simple" else ThreadingWSGIServer
+    with make_server(host, port, app, server_class=server_class) as server:
+        print(f"Serving on http://{host}:{port} ({mode}) (Ctrl+C to stop)")
+        if mode != "prefork":
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                print("\nShutting down...")
+            return
+
+        # Сокет уже открыт - дочерние процессы принимают соединения с него
+        # по очереди. Кэш и пул соединений у каждого процесса свои.
+        # SIGTERM (от supervisor'а, systemd, bench.py) останавливает пул так
+        # же, как Ctrl+C: иначе родитель умирает, а потомки остаются
+        # сиротами и продолжают принимать соединения
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        children = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.default_int_handler)
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+                os._exit(0)
+            children.append(pid)
+
+        alive = set(children)
         try:
-            server.serve_forever()
+            while alive:
+                pid, _ = os.wait()
+                alive.discard(pid)
         except KeyboardInterrupt:
             print("\nShutting down...")
+            # Повторный сигнал не должен прервать ожидание потомков
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            for pid in alive:
+                os.kill(pid, signal.SIGTERM)
+            for pid in alive:
+                os.waitpid(pid, 0)
+
+
+def self_test():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from stub_upstream import StubUpstream
+
+    with StubUpstream() as stub:
+        guard = UpstreamGuard(
+            "stub-wsgi",
+            timeout=0.5,
+            breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60),
+            is_failure=is_upstream_failure,
+        )
+        cache = RatesCache(ConnectionPool(stub.url), ttl=0.3, stale_ttl=5, guard=guard)
+        server = make_server(
+            "127.0.0.1",
+            0,
+            make_app(cache),
+            server_class=ThreadingWSGIServer,
+            handler_class=QuietHandler,
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+
+        def get(path, headers=None):
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", path, headers=headers or {})
+            resp = conn.getresponse()
+            body = resp.read()
+            conn.close()
+            return resp, body
+
+        # Одновременные промахи по одной валюте - один запрос к апстриму
+        stub.delay = 0.2
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(lambda _: get("/usd"), range(10)))
+        assert {resp.status for resp, _ in results} == {200}
+        assert stub.requests == 1
+        stub.delay = 0
+
+        resp, body = get("/USD")
+        assert json.loads(body)["base"] == "USD"
+        assert stub.requests == 1
+        etag = resp.getheader("ETag")
+        assert "max-age=" in resp.getheader("Cache-Control")
+
+        # Условный запрос клиента
+        resp, body = get("/USD", {"If-None-Match": etag})
+        assert resp.status == 304 and body == b""
+        assert get("/USD", {"If-None-Match": f"W/{etag}"})[0].status == 304
+        assert get("/USD", {"If-None-Match": '"other"'})[0].status == 200
+
+        # Устаревшая запись отдаётся сразу, апстрим отвечает 304 в фоне
+        # на том же keep-alive соединении
+        time.sleep(0.35)
+        stub.delay = 0.2
+        start = time.perf_counter()
+        resp, _ = get("/USD")
+        assert resp.status == 200 and time.perf_counter() - start < 0.15
+        time.sleep(0.3)
+        assert stub.requests == 2 and stub.not_modified == 1
+        assert stub.connections == 1
+        stub.delay = 0
+
+        # Новые данные у апстрима - новый ETag для клиентов
+        stub.version = 2
+        time.sleep(0.35)
+        get("/USD")
+        time.sleep(0.1)
+        resp, body = get("/USD")
+        assert resp.getheader("ETag") != etag and json.loads(body)["version"] == 2
+
+        # Ошибки апстрима не кэшируются
+        requests = stub.requests
+        for _ in range(2):
+            resp, _ = get("/CHF")
+            assert resp.status == 404
+            assert resp.getheader("Cache-Control") == "no-store"
+        assert stub.requests == requests + 2
+
+        # Неизвестный код и неверный формат отвечаются без апстрима
+        assert get("/XXX")[0].status == 404
+        assert get("/US1")[0].status == 400
+        assert stub.requests == requests + 2
+        assert guard.breaker.failures == 0
+
+        # Медленный апстрим: ответ 504 по бюджету, а не по таймауту сокета
+        stub.delay = 1.0
+        start = time.perf_counter()
+        assert get("/JPY")[0].status == 504
+        assert time.perf_counter() - start < 0.8
+        stub.delay = 0
+
+        # Апстрим болеет: просроченная запись отдаётся вместо ошибки
+        stub.fail_status = 503
+        cache.stale_ttl = 0
+        time.sleep(0.35)
+        resp, body = get("/USD")
+        assert resp.status == 200 and json.loads(body)["version"] == 2
+        assert get("/EUR")[0].status == 503
+        assert guard.breaker.state == "open"
+
+        # Автомат открыт: без записи в кэше - сразу 503, апстрим не трогаем
+        requests = stub.requests
+        resp, body = get("/GBP")
+        assert resp.status == 503 and "unavailable" in json.loads(body)["error"]
+        assert get("/USD")[0].status == 200
+        assert stub.requests == requests and guard.rejected == 2
+        stub.fail_status = None
+
+        server.shutdown()
+        server.server_close()
+
+        # Одновременные промахи по медленному апстриму получают общий отказ
+        # за один бюджет, а не повторяют загрузку друг за другом
+        stub.delay = 1.0
+        slow = RatesCache(
+            ConnectionPool(stub.url), guard=UpstreamGuard("stub-wsgi", timeout=0.5)
+        )
+
+        def outcome_of(cache):
+            def outcome(currency):
+                try:
+                    return cache.get(currency).body
+                except Exception as e:
+                    return type(e)
+
+            return outcome
+
+        requests = stub.requests
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(outcome_of(slow), ["CAD"] * 6))
+        assert results == [TimeoutError] * 6 and time.perf_counter() - start < 0.8
+        assert stub.requests == requests + 1
+
+        # Без кэша (ttl=0, как bench.py --no-cache) одновременные запросы всё
+        # равно ждут одну загрузку, а не выстраиваются в очередь за ней
+        stub.delay = 0.2
+        uncached = RatesCache(ConnectionPool(stub.url), ttl=0, stale_ttl=0)
+        for _ in range(2):
+            requests = stub.requests
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                results = list(executor.map(outcome_of(uncached), ["EUR"] * 10))
+            assert all(isinstance(body, bytes) for body in results)
+            assert stub.requests == requests + 1
+            assert time.perf_counter() - start < 0.35
+        stub.delay = 0
+
+    print("self-test passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--mode", choices=["simple", "threaded", "prefork"], default="simple"
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--self-test", action="store_true")
+    options = parser.parse_args()
+
+    if options.self_test:
+        self_test()
+    else:
+        serve(app, options.host, options.port, options.mode, options.workers)
@@ -0,0 +1,231 @@
+# Нагрузочный замер прокси курсов валют: одинаковая нагрузка на каждый
+# вариант сервера поверх локального апстрима с заданной задержкой.
+# Запуск:
+#   python bench.py --duration 10 --concurrency 50 --upstream-delay 0.05
+#   python bench.py --servers threaded uvicorn --workers 4 --output bench.json
+#   python bench.py --no-cache --upstream-delay 0.2   # каждый запрос - в апстрим
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+
+HERE = Path(__file__).resolve().parent
+CURRENCIES = ["USD", "EUR", "GBP", "JPY", "RUB"]
+
+
+def server_commands(port: int, workers: int) -> dict[str, list[str]]:
+    wsgi = [sys.executable, "8_wsgi.py", "--port", str(port)]
+    return {
+        "wsgiref": [*wsgi, "--mode", "simple"],
+        "threaded": [*wsgi, "--mode", "threaded"],
+        "prefork": [*wsgi, "--mode", "prefork", "--workers", str(workers)],
+        "uvicorn": [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "8_asgi:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Nothing listens on port {port}")
+
+
+def rss_mb(pid: int) -> float:
+    # Память всего дерева процессов сервера: у prefork и uvicorn --workers
+    # запросы обслуживают дочерние процессы
+    total, pids = 0, [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            status = Path(f"/proc/{current}/status").read_text()
+            for task in Path(f"/proc/{current}/task").iterdir():
+                pids.extend(int(p) for p in (task / "children").read_text().split())
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                total += int(line.split()[1])
+    return round(total / 1024, 1)
+
+
+def _percentile_ms(data: list[float], p: int) -> float:
+    if len(data) < 2:
+        return round(data[0] * 1000, 3) if data else 0.0
+    return round(statistics.quantiles(data, n=100)[p - 1] * 1000, 3)
+
+
+async def drive(url: str, duration: float, concurrency: int) -> dict:
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+    rng = random.Random(42)
+
+    async def client(session: aiohttp.ClientSession):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                async with session.get(f"{url}/{rng.choice(CURRENCIES)}") as resp:
+                    await resp.read()
+                    ok = resp.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    timeout = aiohttp.ClientTimeout(total=30)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "error_rate": round(errors / len(latencies), 4) if latencies else 0.0,
+        "rps": round(len(latencies) / elapsed, 1),
+        "latency_p50_ms": _percentile_ms(latencies, 50),
+        "latency_p95_ms": _percentile_ms(latencies, 95),
+        "latency_p99_ms": _percentile_ms(latencies, 99),
+    }
+
+
+def run_server(name: str, command: list[str], port: int, options) -> dict:
+    env = {**os.environ, "CURRENCY_UPSTREAM": options.upstream}
+    if options.no_cache:
+        # Без кэша в замер попадает задержка апстрима, а не только ответ из памяти
+        env.update(CURRENCY_CACHE_TTL="0", CURRENCY_STALE_TTL="0")
+    server = subprocess.Popen(
+        command,
+        cwd=HERE,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        url = f"http://127.0.0.1:{port}"
+        # Прогрев: первый запрос каждой валюты идёт в апстрим
+        asyncio.run(drive(url, min(1.0, options.duration), len(CURRENCIES)))
+        result = asyncio.run(drive(url, options.duration, options.concurrency))
+        result["rss_mb"] = rss_mb(server.pid)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    return {"server": name, **result}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--servers",
+        nargs="+",
+        default=["wsgiref", "threaded", "prefork", "uvicorn"],
+        choices=["wsgiref", "threaded", "prefork", "uvicorn"],
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument(
+        "--upstream-delay",
+        type=float,
+        default=0.05,
+        help="Задержка локального апстрима в секундах",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Отключить кэш прокси: каждый запрос ждёт апстрим",
+    )
+    parser.add_argument("--output", default="bench_proxies.json")
+    options = parser.parse_args()
+
+    upstream_port = free_port()
+    options.upstream = f"http://127.0.0.1:{upstream_port}"
+    upstream = subprocess.Popen(
+        [
+            sys.executable,
+            "stub_upstream.py",
+            "--port",
+            str(upstream_port),
+            "--delay",
+            str(options.upstream_delay),
+        ],
+        cwd=HERE,
+        stdout=subprocess.DEVNULL,
+    )
+
+    results = []
+    try:
+        wait_for_port(upstream_port)
+        for name in options.servers:
+            port = free_port()
+            command = server_commands(port, options.workers)[name]
+            result = run_server(name, command, port, options)
+            results.append(result)
+            print(
+                f"{name:<9} {result['rps']:8.0f} rps  "
+                f"p50 {result['latency_p50_ms']}ms  "
+                f"p95 {result['latency_p95_ms']}ms  "
+                f"p99 {result['latency_p99_ms']}ms  "
+                f"rss {result['rss_mb']}MB  "
+                f"errors {result['error_rate']:.2%}"
+            )
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+    with open(options.output, "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "duration": options.duration,
+                "concurrency": options.concurrency,
+                "workers": options.workers,
+                "upstream_delay": options.upstream_delay,
+                "cache": not options.no_cache,
+                "results": results,
+            },
+            file,
+            ensure_ascii=False,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
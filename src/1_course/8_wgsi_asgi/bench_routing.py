@@ -0,0 +1,161 @@
+# Микробенчмарк разбора пути и ответов с ошибками: прежние обработчики
+# (скопированы ниже без изменений) против общего слоя из routing.py.
+# Запуск:
+#   python bench_routing.py
+
+import json
+import re
+import timeit
+from http import HTTPStatus
+
+from routing import route
+
+# --- Прежняя реализация -----------------------------------------------------
+
+
+def _http_status_line(status_code: int) -> str:
+    try:
+        reason = HTTPStatus(status_code).phrase
+    except Exception:
+        reason = "OK"
+    return f"{status_code} {reason}"
+
+
+def _error(start_response, status: int, message: str):
+    body = json.dumps({"error": message}).encode("utf-8")
+    start_response(
+        _http_status_line(status),
+        [
+            ("Content-Type", "application/json; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+            ("Cache-Control", "no-store"),
+        ],
+    )
+    return [body]
+
+
+def legacy_wsgi(environ, start_response):
+    method = environ.get("REQUEST_METHOD", "GET").upper()
+    path = environ.get("PATH_INFO", "/")
+
+    if path == "/favicon.ico":
+        start_response(_http_status_line(204), [])
+        return [b""]
+    if method != "GET":
+        return _error(start_response, 405, "Method Not Allowed (use GET)")
+
+    currency = path.strip("/")
+    if not currency:
+        return _error(start_response, 404, "Not found")
+    if not re.fullmatch(r"[A-Za-z]{3}", currency):
+        return _error(
+            start_response, 400, "Currency must be 3 latin letters, e.g. USD, EUR"
+        )
+    return currency.upper()
+
+
+async def send_json_error(send, status: int, message: str):
+    body = json.dumps({"error": message}).encode("utf-8")
+    headers = [
+        (b"content-type", b"application/json; charset=utf-8"),
+        (b"content-length", str(len(body)).encode("ascii")),
+        (b"cache-control", b"no-store"),
+        (b"access-control-allow-origin", b"*"),
+    ]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+def parse_currency(path: str) -> str | None:
+    currency = path.strip("/")
+    if not re.fullmatch(r"[A-Za-z]{3}", currency or ""):
+        return None
+    return currency.upper()
+
+
+async def legacy_asgi(scope, send):
+    currency = parse_currency(scope["path"])
+    if not currency:
+        await send_json_error(send, 400, "Usage: GET /USD (3-letter currency code)")
+        return None
+    return currency
+
+
+# --- Общий слой ---------------------------------------------------------------
+
+
+def new_wsgi(environ, start_response):
+    currency = route(
+        environ.get("REQUEST_METHOD", "GET").upper(), environ.get("PATH_INFO", "/")
+    )
+    if not isinstance(currency, str):
+        start_response(currency.status_line, list(currency.headers))
+        return [currency.body]
+    return currency
+
+
+async def new_asgi(scope, send):
+    currency = route(scope["method"], scope["path"])
+    if not isinstance(currency, str):
+        await send(currency.asgi_start)
+        await send(currency.asgi_body)
+        return None
+    return currency
+
+
+def start_response(status, headers):
+    pass
+
+
+async def send(message):
+    pass
+
+
+def run_async(handler, scope, n):
+    # Корутина прогоняется без цикла событий: send ничего не ждёт
+    for _ in range(n):
+        coro = handler(scope, send)
+        try:
+            coro.send(None)
+        except StopIteration:
+            pass
+
+
+def benchmark_routing(n=200_000):
+    cases = {
+        "valid /usd": "/usd",
+        "bad /US1": "/US1",
+        "empty /": "/",
+        "favicon": "/favicon.ico",
+    }
+    for name, path in cases.items():
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path}
+        legacy = timeit.timeit(lambda: legacy_wsgi(environ, start_response), number=n)
+        new = timeit.timeit(lambda: new_wsgi(environ, start_response), number=n)
+        print(
+            f"wsgi {name:<12} legacy {n / legacy:9.0f} ops/s  "
+            f"new {n / new:9.0f} ops/s  x{legacy / new:.1f}"
+        )
+
+    for name, path in (("valid /usd", "/usd"), ("bad /US1", "/US1")):
+        scope = {"method": "GET", "path": path}
+        legacy = timeit.timeit(lambda: run_async(legacy_asgi, scope, n), number=1)
+        new = timeit.timeit(lambda: run_async(new_asgi, scope, n), number=1)
+        print(
+            f"asgi {name:<12} legacy {n / legacy:9.0f} ops/s  "
+            f"new {n / new:9.0f} ops/s  x{legacy / new:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    # Обе реализации разбирают путь одинаково
+    for path in ("/usd", "/USD/", "/US1", "/"):
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path}
+        statuses = []
+        for handler in (legacy_wsgi, new_wsgi):
+            result = handler(environ, lambda status, headers: statuses.append(status))
+            if isinstance(result, str):
+                statuses.append(result)
+        assert statuses[0] == statuses[1], (path, statuses)
+
+    benchmark_routing()
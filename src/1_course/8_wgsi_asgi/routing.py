@@ -0,0 +1,174 @@
+# Общий для 8_wsgi.py и 8_asgi.py разбор пути, готовые ответы и заголовки
+# кэширования. Всё, что не зависит от запроса, собирается один раз при
+# импорте: строки статусов, тела и заголовки ошибок в виде байтов, таблица
+# допустимых путей
+import hashlib
+import json
+import os
+import re
+import time
+from http import HTTPStatus
+from typing import NamedTuple
+
+PROVIDER = "https://www.exchangerate-api.com"
+
+# Курсы обновляются раз в сутки: час отдаём из памяти как свежие, ещё
+# сутки - как устаревшие, параллельно обновляя в фоне
+CACHE_TTL = float(os.environ.get("CURRENCY_CACHE_TTL", 3600))
+STALE_TTL = float(os.environ.get("CURRENCY_STALE_TTL", 86400))
+
+CURRENCY_RE = re.compile(r"[A-Za-z]{3}")
+
+# Коды ISO 4217, которые поддерживает провайдер. Неизвестный код получает
+# 404 сразу, без запроса в апстрим
+CURRENCIES = frozenset(
+    """
+    AED AFN ALL AMD ANG AOA ARS AUD AWG AZN BAM BBD BDT BGN BHD BIF BMD BND
+    BOB BRL BSD BTN BWP BYN BZD CAD CDF CHF CLP CNY COP CRC CUP CVE CZK DJF
+    DKK DOP DZD EGP ERN ETB EUR FJD FKP FOK GBP GEL GGP GHS GIP GMD GNF GTQ
+    GYD HKD HNL HRK HTG HUF IDR ILS IMP INR IQD IRR ISK JEP JMD JOD JPY KES
+    KGS KHR KID KMF KRW KWD KYD KZT LAK LBP LKR LRD LSL LYD MAD MDL MGA MKD
+    MMK MNT MOP MRU MUR MVR MWK MXN MYR MZN NAD NGN NIO NOK NPR NZD OMR PAB
+    PEN PGK PHP PKR PLN PYG QAR RON RSD RUB RWF SAR SBD SCR SDG SEK SGD SHP
+    SLE SLL SOS SRD SSP STN SYP SZL THB TJS TMT TND TOP TRY TTD TVD TWD TZS
+    UAH UGX USD UYU UZS VES VND VUV WST XAF XCD XDR XOF XPF YER ZAR ZMW ZWL
+    """.split()
+)
+
+# Путь -> код валюты для всех допустимых написаний: горячий путь - один
+# поиск в словаре вместо strip, регулярного выражения и upper
+_ROUTES = {}
+for _code in CURRENCIES:
+    for _variant in (_code, _code.lower(), _code.capitalize()):
+        _ROUTES[f"/{_variant}"] = _code
+        _ROUTES[f"/{_variant}/"] = _code
+del _code, _variant
+
+ALLOWED_METHODS = frozenset({"GET", "HEAD"})
+
+_STATUS_LINES = {
+    status.value: f"{status.value} {status.phrase}" for status in HTTPStatus
+}
+
+
+def status_line(status: int) -> str:
+    line = _STATUS_LINES.get(status)
+    return line if line is not None else f"{status} OK"
+
+
+class Response(NamedTuple):
+    status: int
+    status_line: str
+    headers: list[tuple[str, str]]
+    body: bytes
+    # Готовые сообщения ASGI: их можно отправлять повторно без пересборки
+    asgi_start: dict
+    asgi_body: dict
+
+
+def make_response(status: int, body: bytes, headers: list[tuple[str, str]]) -> Response:
+    if body or status not in (204, 304):
+        headers = [*headers, ("Content-Length", str(len(body)))]
+    asgi_headers = [
+        (name.lower().encode("latin-1"), value.encode("latin-1"))
+        for name, value in headers
+    ]
+    return Response(
+        status,
+        status_line(status),
+        headers,
+        body,
+        {"type": "http.response.start", "status": status, "headers": asgi_headers},
+        {"type": "http.response.body", "body": body, "more_body": False},
+    )
+
+
+def json_response(status: int, body: bytes) -> Response:
+    # Ответ апстрима с ошибкой: передаём как есть и не разрешаем кэшировать
+    return make_response(
+        status,
+        body,
+        [
+            ("Content-Type", "application/json; charset=utf-8"),
+            ("Cache-Control", "no-store"),
+            ("Access-Control-Allow-Origin", "*"),
+            ("X-Proxy-Provider", PROVIDER),
+        ],
+    )
+
+
+def error_response(status: int, message: str) -> Response:
+    return json_response(status, json.dumps({"error": message}).encode("utf-8"))
+
+
+NO_CONTENT = make_response(204, b"", [])
+BAD_REQUEST = error_response(400, "Currency must be 3 latin letters, e.g. USD, EUR")
+NOT_FOUND = error_response(404, "Not found")
+UNKNOWN_CURRENCY = error_response(404, "Unknown currency code")
+METHOD_NOT_ALLOWED = error_response(405, "Method Not Allowed (use GET/HEAD)")
+UNSUPPORTED_SCOPE = error_response(404, "Unsupported scope type")
+INTERNAL_ERROR = error_response(500, "Internal Server Error")
+GATEWAY_TIMEOUT = error_response(504, "Gateway Timeout")
+UPSTREAM_UNAVAILABLE = error_response(503, "Upstream unavailable, try again later")
+
+
+def route(method: str, path: str) -> Response | str:
+    # Код валюты для запроса в апстрим или готовый ответ
+    if method not in ALLOWED_METHODS:
+        return NO_CONTENT if path == "/favicon.ico" else METHOD_NOT_ALLOWED
+
+    currency = _ROUTES.get(path)
+    if currency is not None:
+        return currency
+
+    if path == "/favicon.ico":
+        return NO_CONTENT
+    code = path.strip("/")
+    if not code:
+        return NOT_FOUND
+    if not CURRENCY_RE.fullmatch(code):
+        return BAD_REQUEST
+    code = code.upper()
+    # Смешанный регистр вроде "uSd" в таблицу путей не попал
+    return code if code in CURRENCIES else UNKNOWN_CURRENCY
+
+
+class CacheEntry(NamedTuple):
+    body: bytes
+    etag: str
+    upstream_etag: str | None
+    fetched_at: float
+
+
+def cache_entry(body: bytes, upstream_etag: str | None) -> CacheEntry:
+    # Свой ETag по содержимому: у апстрима его может не быть
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+    return CacheEntry(body, f'"{etag}"', upstream_etag, time.monotonic())
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # Для If-None-Match сравнение слабое: W/"x" совпадает с "x"
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+    )
+
+
+def cache_headers(
+    entry: CacheEntry, ttl: float, stale_ttl: float
+) -> list[tuple[str, str]]:
+    # Заголовки ответа из кэша, общие для 200 и 304
+    age = int(time.monotonic() - entry.fetched_at)
+    max_age = max(0, int(ttl) - age)
+    return [
+        (
+            "Cache-Control",
+            f"public, max-age={max_age}, stale-while-revalidate={int(stale_ttl)}",
+        ),
+        ("ETag", entry.etag),
+        ("Age", str(age)),
+        ("Access-Control-Allow-Origin", "*"),
+        ("Access-Control-Expose-Headers", "Content-Type, ETag"),
+        ("X-Proxy-Provider", PROVIDER),
+    ]
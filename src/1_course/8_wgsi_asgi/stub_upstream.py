@@ -0,0 +1,142 @@
+# Локальная замена api.exchangerate-api.com для проверок и замеров прокси.
+# Запуск:
+#   python stub_upstream.py --port 9000 --delay 0.05
+#   CURRENCY_UPSTREAM=http://127.0.0.1:9000 python 8_wsgi.py
+
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RATES = {"USD": 1.0, "EUR": 0.92, "GBP": 0.79, "JPY": 151.6, "RUB": 92.5}
+
+_PATH_RE = re.compile(r"/v4/latest/([A-Z]{3})")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент ушёл, не дождавшись ответа: таймаут или отменённый дубль
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubUpstream:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, delay: float = 0.0):
+        # Число секунд или функция от номера запроса (с 1)
+        self.delay = delay
+        # Код ошибки, которым отвечать на все запросы, например 503
+        self.fail_status: int | None = None
+        # Меняется, когда тест хочет, чтобы данные "обновились"
+        self.version = 1
+        self.requests = self.not_modified = self.connections = 0
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                stub._handle(self)
+
+        self.server = _Server((host, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubUpstream":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handle(self, handler: BaseHTTPRequestHandler) -> None:
+        with self._lock:
+            self.requests += 1
+            number = self.requests
+        delay = self.delay(number) if callable(self.delay) else self.delay
+        if delay:
+            time.sleep(delay)
+
+        if self.fail_status is not None:
+            body = json.dumps({"result": "error"}).encode("utf-8")
+            self._send(handler, self.fail_status, body)
+            return
+
+        match = _PATH_RE.fullmatch(handler.path)
+        if not match or match[1] not in RATES:
+            body = json.dumps(
+                {"result": "error", "error-type": "unsupported-code"}
+            ).encode("utf-8")
+            self._send(handler, 404, body)
+            return
+
+        code = match[1]
+        etag = f'"{code}-{self.version}"'
+        if handler.headers.get("If-None-Match") == etag:
+            with self._lock:
+                self.not_modified += 1
+            self._send(handler, 304, b"", etag)
+            return
+
+        base = RATES[code]
+        body = json.dumps(
+            {
+                "base": code,
+                "version": self.version,
+                "rates": {k: round(v / base, 6) for k, v in RATES.items()},
+            }
+        ).encode("utf-8")
+        self._send(handler, 200, body, etag)
+
+    @staticmethod
+    def _send(handler, status: int, body: bytes, etag: str | None = None) -> None:
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        if etag:
+            handler.send_header("ETag", etag)
+        if status != 304:
+            handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if status != 304:
+            handler.wfile.write(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--delay", type=float, default=0.0)
+    options = parser.parse_args()
+
+    stub = StubUpstream(options.host, options.port, options.delay)
+    print(f"Stub upstream on {stub.url} (Ctrl+C to stop)")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
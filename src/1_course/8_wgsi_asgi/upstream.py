@@ -0,0 +1,417 @@
+# Защита вызовов апстрима, общая для 8_wsgi.py и 8_asgi.py: автомат
+# (circuit breaker), ограничение одновременных вызовов, бюджет времени,
+# дублирующие (hedged) запросы и гистограммы задержек по апстримам.
+# Проверка:
+#   python upstream.py
+
+import asyncio
+import bisect
+import math
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class UpstreamBusyError(UpstreamUnavailable):
+    pass
+
+
+class UpstreamError(Exception):
+    # Апстрим ответил статусом, отличным от 200 и 304
+    def __init__(self, status: int, body: bytes):
+        super().__init__(status)
+        self.status = status
+        self.body = body
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    # 4xx - ответ на неверный запрос, апстрим при этом здоров
+    return not (isinstance(exc, UpstreamError) and exc.status < 500)
+
+
+UPSTREAM = os.environ.get("CURRENCY_UPSTREAM", "https://api.exchangerate-api.com")
+
+# Бюджет на запрос к апстриму вместе с ожиданием слота и дублем: дольше
+# клиенту ждать нет смысла, а поток или соединение сервера не должны висеть
+# до таймаута сокета
+UPSTREAM_TIMEOUT = 3
+UPSTREAM_CONCURRENCY = 10
+HEDGE_AFTER = 1.0
+
+
+class CircuitBreaker:
+    # closed: вызовы идут, ошибки подряд считаются. После failure_threshold
+    # ошибок - open: вызовы сразу отклоняются. Через reset_timeout - half_open:
+    # проходит один пробный вызов, его исход закрывает или снова открывает автомат
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            # В half_open повторная проба нужна, если прежняя не отчиталась
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class LatencyHistogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, p: float) -> float:
+        # Верхняя граница корзины, в которую попадает p-й процентиль
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0,
+            "p50_le_ms": self.percentile(50) * 1000,
+            "p95_le_ms": self.percentile(95) * 1000,
+            "p99_le_ms": self.percentile(99) * 1000,
+            "buckets": {
+                f"le_{bound * 1000:g}ms" if bound != math.inf else "le_inf": count
+                for bound, count in zip(self.buckets, self.counts)
+            },
+        }
+
+
+# Гистограммы по имени апстрима: защиты одного апстрима пишут в одну
+HISTOGRAMS: dict[str, LatencyHistogram] = {}
+
+
+def _always_failure(exc: BaseException) -> bool:
+    return True
+
+
+class UpstreamGuard:
+    # timeout - бюджет на весь вызов, включая ожидание слота и дублирующий
+    # запрос. hedge_after - через сколько секунд без ответа отправить второй
+    # запрос (только если есть свободный слот); None - не дублировать.
+    # is_failure решает, какие исключения считать отказом апстрима
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = 10,
+        timeout: float = 10,
+        hedge_after: float | None = None,
+        breaker: CircuitBreaker | None = None,
+        is_failure=_always_failure,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.is_failure = is_failure
+        self.histogram = HISTOGRAMS.setdefault(name, LatencyHistogram())
+        self.rejected = self.busy = self.hedged = self.timeouts = 0
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._async_slots: asyncio.Semaphore | None = None
+        self._executor: ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.breaker.state,
+            "rejected": self.rejected,
+            "busy": self.busy,
+            "hedged": self.hedged,
+            "timeouts": self.timeouts,
+            "latency": self.histogram.snapshot(),
+        }
+
+    def _check_circuit(self) -> None:
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise CircuitOpenError(f"{self.name}: circuit open")
+
+    def _record(self, exc: BaseException | None) -> None:
+        if exc is None or not self.is_failure(exc):
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def _timeout(self) -> TimeoutError:
+        self.timeouts += 1
+        return TimeoutError(f"{self.name}: no response within {self.timeout}s")
+
+    # --- Потоки ---------------------------------------------------------------
+
+    def _submit(self, fn):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_concurrency, thread_name_prefix=f"upstream-{self.name}"
+                )
+        start = time.perf_counter()
+
+        def run():
+            # Слот занят, пока запрос действительно идёт, даже если
+            # вызывающий уже ушёл по таймауту
+            try:
+                return fn()
+            finally:
+                self.histogram.observe(time.perf_counter() - start)
+                self._slots.release()
+
+        return self._executor.submit(run)
+
+    def call(self, fn):
+        self._check_circuit()
+        deadline = time.monotonic() + self.timeout
+
+        if not self._slots.acquire(timeout=self.timeout):
+            self.busy += 1
+            raise UpstreamBusyError(f"{self.name}: too many calls in flight")
+        pending = {self._submit(fn)}
+
+        if self.hedge_after is not None:
+            done, _ = wait(pending, timeout=min(self.hedge_after, self.timeout))
+            if not done and self._slots.acquire(blocking=False):
+                self.hedged += 1
+                pending.add(self._submit(fn))
+
+        # Побеждает первый успешный ответ; отказ ждёт оставшиеся попытки
+        error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                exc = future.exception()
+                if exc is None or not self.is_failure(exc):
+                    self._record(exc)
+                    return future.result()
+                error = exc
+
+        if pending or error is None:
+            error = self._timeout()
+        self._record(error)
+        raise error
+
+    # --- asyncio --------------------------------------------------------------
+
+    def _start(self, factory) -> asyncio.Task:
+        start = time.perf_counter()
+
+        async def run():
+            try:
+                return await factory()
+            finally:
+                self.histogram.observe(time.perf_counter() - start)
+                self._async_slots.release()
+
+        return asyncio.ensure_future(run())
+
+    async def acall(self, factory):
+        self._check_circuit()
+        deadline = time.monotonic() + self.timeout
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_concurrency)
+
+        try:
+            await asyncio.wait_for(self._async_slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.busy += 1
+            raise UpstreamBusyError(f"{self.name}: too many calls in flight") from None
+        pending = {self._start(factory)}
+
+        try:
+            if self.hedge_after is not None:
+                done, _ = await asyncio.wait(
+                    pending, timeout=min(self.hedge_after, self.timeout)
+                )
+                if not done and not self._async_slots.locked():
+                    await self._async_slots.acquire()
+                    self.hedged += 1
+                    pending.add(self._start(factory))
+
+            error = None
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    exc = task.exception()
+                    if exc is None or not self.is_failure(exc):
+                        self._record(exc)
+                        return task.result()
+                    error = exc
+
+            if pending or error is None:
+                error = self._timeout()
+            self._record(error)
+            raise error
+        finally:
+            # Проигравший или опоздавший запрос отменяется и освобождает слот
+            for task in pending:
+                task.cancel()
+
+
+if __name__ == "__main__":
+    import json
+    import urllib.request
+
+    from stub_upstream import StubUpstream
+
+    def fetch(url):
+        with urllib.request.urlopen(url, timeout=5) as resp:
+            return resp.read()
+
+    with StubUpstream() as stub:
+        url = f"{stub.url}/v4/latest/USD"
+
+        # Автомат: после трёх отказов вызовы не доходят до апстрима
+        guard = UpstreamGuard(
+            "stub-breaker",
+            breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.2),
+        )
+        stub.fail_status = 503
+        for _ in range(3):
+            try:
+                guard.call(lambda: fetch(url))
+            except urllib.error.HTTPError:
+                pass
+        assert guard.breaker.state == "open"
+        requests = stub.requests
+        try:
+            guard.call(lambda: fetch(url))
+        except CircuitOpenError:
+            pass
+        assert stub.requests == requests and guard.rejected == 1
+
+        # Через reset_timeout пробный вызов закрывает автомат
+        stub.fail_status = None
+        time.sleep(0.25)
+        assert json.loads(guard.call(lambda: fetch(url)))["base"] == "USD"
+        assert guard.breaker.state == "closed"
+
+        # Бюджет времени: медленный апстрим не держит вызывающего дольше timeout
+        stub.delay = 0.5
+        guard = UpstreamGuard("stub-slow", timeout=0.1)
+        start = time.perf_counter()
+        try:
+            guard.call(lambda: fetch(url))
+        except TimeoutError:
+            pass
+        assert time.perf_counter() - start < 0.2 and guard.timeouts == 1
+
+        # Не больше max_concurrency запросов одновременно
+        guard = UpstreamGuard("stub-busy", max_concurrency=2, timeout=0.2)
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = [
+                executor.submit(guard.call, lambda: fetch(url)) for _ in range(5)
+            ]
+        outcomes = [type(f.exception()).__name__ for f in futures]
+        assert outcomes.count("UpstreamBusyError") == 3, outcomes
+        time.sleep(0.5)
+
+        # Дублирующий запрос: первый застрял, второй отвечает быстро
+        slow = stub.requests + 1
+        stub.delay = lambda n: 1.0 if n == slow else 0.0
+        guard = UpstreamGuard("stub-hedge", timeout=0.5, hedge_after=0.05)
+        start = time.perf_counter()
+        assert json.loads(guard.call(lambda: fetch(url)))["base"] == "USD"
+        assert time.perf_counter() - start < 0.3 and guard.hedged == 1
+
+        async def check_async():
+            import aiohttp
+
+            async with aiohttp.ClientSession() as session:
+
+                async def afetch():
+                    async with session.get(url) as resp:
+                        resp.raise_for_status()
+                        return await resp.read()
+
+                # Те же сценарии для asyncio: дублирование и бюджет
+                slow = stub.requests + 1
+                stub.delay = lambda n: 1.0 if n == slow else 0.0
+                guard = UpstreamGuard("stub-async", timeout=0.5, hedge_after=0.05)
+                start = time.perf_counter()
+                assert json.loads(await guard.acall(afetch))["base"] == "USD"
+                assert time.perf_counter() - start < 0.3 and guard.hedged == 1
+
+                stub.delay = 0.5
+                start = time.perf_counter()
+                try:
+                    await guard.acall(afetch)
+                except TimeoutError:
+                    pass
+                assert time.perf_counter() - start < 0.7 and guard.timeouts == 1
+
+                stub.delay = 0
+                stub.fail_status = 503
+                guard = UpstreamGuard(
+                    "stub-async", breaker=CircuitBreaker(failure_threshold=2)
+                )
+                for _ in range(3):
+                    try:
+                        await guard.acall(afetch)
+                    except (aiohttp.ClientResponseError, CircuitOpenError):
+                        pass
+                assert guard.breaker.state == "open" and guard.rejected == 1
+                stub.fail_status = None
+
+                stats = guard.stats()
+                assert stats["latency"]["count"] == HISTOGRAMS["stub-async"].count > 0
+
+        asyncio.run(check_async())
+        stub.delay = 0
+
+    print(json.dumps(HISTOGRAMS["stub-hedge"].snapshot(), indent=2))
@@ -0,0 +1,185 @@
+import json
+import statistics
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import F
+
+from task_queue.models import TaskQueue
+from task_queue.service import enqueue_many, fetch_tasks
+from task_queue.worker import mp_context
+
+PREFIX = "bench-"
+
+
+def timed_metric() -> str:
+    # На SQLite с IMMEDIATE блокировку на запись ждёт BEGIN. На Postgres
+    # SELECT ... FOR UPDATE SKIP LOCKED никогда не ждёт чужих блокировок,
+    # поэтому там замеряется просто время этого запроса
+    return "lock_wait" if connection.vendor == "sqlite" else "for_update_query"
+
+
+class LockWaitTimer:
+    def __init__(self):
+        self.elapsed = 0.0
+        self.marker = "BEGIN" if connection.vendor == "sqlite" else "FOR UPDATE"
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.marker not in sql:
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+
+def _claimer(barrier, results, batch_size: int) -> None:
+    connections.close_all()
+    latencies, lock_waits, claimed_ids = [], [], []
+
+    barrier.wait()
+    while True:
+        timer = LockWaitTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            tasks = fetch_tasks(batch_size)
+        latencies.append(time.perf_counter() - start)
+        lock_waits.append(timer.elapsed)
+
+        if not tasks:
+            break
+        claimed_ids.extend(task.pk for task in tasks)
+
+    results.put((latencies, lock_waits, claimed_ids))
+    connections.close_all()
+
+
+def _percentile_ms(data: list[float], p: int) -> float:
+    if len(data) < 2:
+        return round(data[0] * 1000, 3) if data else 0.0
+    return round(statistics.quantiles(data, n=100)[p - 1] * 1000, 3)
+
+
+def run_mode(n: int, processes: int, batch_size: int) -> dict:
+    # Удаляем только свои строки, в том числе оставшиеся от прерванного запуска
+    bench_tasks = TaskQueue.objects.filter(task_name__startswith=PREFIX)
+    bench_tasks.delete()
+    enqueue_many(f"{PREFIX}{i}" for i in range(n))
+    connections.close_all()
+
+    barrier = mp_context.Barrier(processes + 1)
+    results = mp_context.Queue()
+    workers = [
+        mp_context.Process(target=_claimer, args=(barrier, results, batch_size))
+        for _ in range(processes)
+    ]
+    for p in workers:
+        p.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    latencies, lock_waits, claimed_ids = [], [], []
+    for _ in workers:
+        worker_latencies, worker_lock_waits, worker_ids = results.get()
+        latencies.extend(worker_latencies)
+        lock_waits.extend(worker_lock_waits)
+        claimed_ids.extend(worker_ids)
+    elapsed = time.perf_counter() - start
+    for p in workers:
+        p.join()
+
+    bench_tasks.delete()
+    # С --force процессы могли захватить настоящие задачи - возвращаем их
+    TaskQueue.objects.filter(pk__in=claimed_ids, status="in_progress").update(
+        status="pending", lease_expires_at=None, attempts=F("attempts") - 1
+    )
+
+    # Каждая задача должна достаться ровно одному процессу
+    double_claims = sum(c - 1 for c in Counter(claimed_ids).values())
+
+    metric = timed_metric()
+    return {
+        "batch_size": batch_size,
+        "claimed": len(claimed_ids),
+        "unique_claimed": len(claimed_ids) - double_claims,
+        "elapsed": round(elapsed, 3),
+        "claims_per_sec": round(len(claimed_ids) / elapsed, 1),
+        "claim_calls": len(latencies),
+        "latency_p50_ms": _percentile_ms(latencies, 50),
+        "latency_p99_ms": _percentile_ms(latencies, 99),
+        f"{metric}_total_s": round(sum(lock_waits), 3),
+        f"{metric}_p50_ms": _percentile_ms(lock_waits, 50),
+        f"{metric}_p99_ms": _percentile_ms(lock_waits, 99),
+        "double_claims": double_claims,
+        "double_claim_rate": double_claims / len(claimed_ids) if claimed_ids else 0.0,
+    }
+
+
+class Command(BaseCommand):
+    help = "Замеряет захват задач под конкуренцией процессов на текущей базе"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tasks", type=int, default=10_000)
+        parser.add_argument("--processes", type=int, default=4)
+        parser.add_argument(
+            "--batch-sizes",
+            type=int,
+            nargs="+",
+            default=[1, 10, 50],
+            help="Размеры пачек fetch_tasks(); 1 - захват по одной задаче",
+        )
+        parser.add_argument("--output", default="bench_claims.json")
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Запустить, даже если в очереди есть настоящие pending-задачи: "
+            "бенчмарк захватит их наравне со своими и затем вернёт в pending",
+        )
+
+    def handle(self, *args, **options):
+        n, processes = options["tasks"], options["processes"]
+
+        foreign = (
+            TaskQueue.objects.filter(status="pending")
+            .exclude(task_name__startswith=PREFIX)
+            .count()
+        )
+        if foreign and not options["force"]:
+            raise CommandError(
+                f"Queue has {foreign} pending tasks that the benchmark would claim; "
+                "run it on a dedicated database or pass --force"
+            )
+
+        metric = timed_metric()
+        results = []
+        for batch_size in options["batch_sizes"]:
+            result = run_mode(n, processes, batch_size)
+            results.append(result)
+            self.stdout.write(
+                f"{connection.vendor} batch={batch_size}: "
+                f"{result['claims_per_sec']:.0f} claims/sec, "
+                f"p50 {result['latency_p50_ms']}ms, "
+                f"p99 {result['latency_p99_ms']}ms, "
+                f"{metric.replace('_', ' ')} {result[f'{metric}_total_s']}s, "
+                f"double claims {result['double_claims']}"
+            )
+
+        with open(options["output"], "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "backend": connection.vendor,
+                    "tasks": n,
+                    "processes": processes,
+                    "results": results,
+                },
+                file,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+        if any(result["double_claims"] for result in results):
+            raise CommandError("Some tasks were claimed more than once")
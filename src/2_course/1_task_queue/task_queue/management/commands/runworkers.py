@@ -0,0 +1,45 @@
+import datetime
+import os
+
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import autodiscover_modules
+
+from task_queue.service import DEFAULT_LEASE, MAX_ATTEMPTS
+from task_queue.worker import handlers, run_pool
+
+
+class Command(BaseCommand):
+    help = "Запускает пул процессов-воркеров, выполняющих задачи из TaskQueue"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+        parser.add_argument("--batch-size", type=int, default=10)
+        parser.add_argument("--min-sleep", type=float, default=0.05)
+        parser.add_argument("--max-sleep", type=float, default=2.0)
+        parser.add_argument(
+            "--lease",
+            type=float,
+            default=DEFAULT_LEASE.total_seconds(),
+            help="Время аренды задачи в секундах, продлевается heartbeat'ом",
+        )
+        parser.add_argument("--reap-interval", type=float, default=5.0)
+        parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+
+    def handle(self, *args, **options):
+        # Обработчики регистрируются в модулях tasks.py приложений
+        autodiscover_modules("tasks")
+
+        self.stdout.write(
+            f"Starting {options['processes']} workers, "
+            f"handlers: {', '.join(sorted(handlers)) or '-'}"
+        )
+        run_pool(
+            options["processes"],
+            reap_interval=options["reap_interval"],
+            max_attempts=options["max_attempts"],
+            batch_size=options["batch_size"],
+            min_sleep=options["min_sleep"],
+            max_sleep=options["max_sleep"],
+            lease=datetime.timedelta(seconds=options["lease"]),
+        )
+        self.stdout.write("Workers stopped")
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("task_queue", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="taskqueue",
+            index=models.Index(
+                fields=["status", "created_at"], name="task_status_created_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("task_queue", "0002_taskqueue_status_created_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="taskqueue",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="taskqueue",
+            name="lease_expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="taskqueue",
+            index=models.Index(
+                fields=["status", "lease_expires_at"], name="task_status_lease_idx"
+            ),
+        ),
+    ]
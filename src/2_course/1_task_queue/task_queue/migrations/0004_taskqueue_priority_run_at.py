@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:04
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def copy_created_at(apps, schema_editor):
+    # Существующие задачи сохраняют свой FIFO-порядок
+    TaskQueue = apps.get_model("task_queue", "TaskQueue")
+    TaskQueue.objects.update(run_at=F("created_at"))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("task_queue", "0003_taskqueue_lease"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="taskqueue",
+            name="task_status_created_idx",
+        ),
+        migrations.AddField(
+            model_name="taskqueue",
+            name="priority",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="taskqueue",
+            name="run_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(copy_created_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="taskqueue",
+            index=models.Index(
+                fields=["status", "-priority", "run_at"],
+                name="task_status_priority_run_idx",
+            ),
+        ),
+    ]
@@ -1,11 +1,30 @@
 from django.db import models
+from django.utils import timezone
 
 
 class TaskQueue(models.Model):
     task_name = models.CharField(max_length=255)
     status = models.CharField(max_length=50, default="pending")  # Статус задачи
+    priority = models.IntegerField(default=0)  # Больше - важнее
+    run_at = models.DateTimeField(default=timezone.now)  # Не раньше этого времени
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Выборка pending-задач в порядке (priority desc, run_at) идёт
+            # по индексу, без сортировки
+            models.Index(
+                fields=["status", "-priority", "run_at"],
+                name="task_status_priority_run_idx",
+            ),
+            # Поиск просроченных in_progress-задач для reaper'а
+            models.Index(
+                fields=["status", "lease_expires_at"], name="task_status_lease_idx"
+            ),
+        ]
+
     def __str__(self):
         return self.task_name
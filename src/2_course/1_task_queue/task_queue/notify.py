@@ -0,0 +1,49 @@
+import select
+
+from django.db import connection
+
+CHANNEL = "task_queue"
+
+
+def is_postgres() -> bool:
+    return connection.vendor == "postgresql"
+
+
+def notify() -> None:
+    # NOTIFY внутри транзакции доставляется слушателям только после COMMIT
+    if not is_postgres():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_notify(%s, '')", [CHANNEL])
+
+
+# Ожидание NOTIFY на соединении воркера вместо опроса базы.
+# Поддерживает оба драйвера Django для Postgres: psycopg2 и psycopg 3
+class Listener:
+    def __init__(self, channel: str = CHANNEL):
+        self.channel = channel
+        self._conn = None
+
+    def _listen(self):
+        connection.ensure_connection()
+        conn = connection.connection
+        if conn is not self._conn:
+            # Соединение могло быть переоткрыто - подписываемся заново
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self.channel}"')
+            self._conn = conn
+        return conn
+
+    def wait(self, timeout: float) -> bool:
+        conn = self._listen()
+
+        if hasattr(conn, "poll"):  # psycopg2
+            conn.poll()
+            if not conn.notifies and select.select([conn], [], [], timeout)[0]:
+                conn.poll()
+            woke = bool(conn.notifies)
+            conn.notifies.clear()
+            return woke
+
+        # psycopg 3
+        return any(True for _ in conn.notifies(timeout=timeout, stop_after=1))
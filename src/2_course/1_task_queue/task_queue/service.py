@@ -1,21 +1,141 @@
+import datetime
+from collections import defaultdict
+from typing import Iterable
+
 from django.db import transaction
+from django.db.models import F, Q, QuerySet
+from django.utils import timezone
 
 from .models import TaskQueue
+from .notify import notify
+
+DEFAULT_LEASE = datetime.timedelta(seconds=60)
+MAX_ATTEMPTS = 5
+
+
+def enqueue_many(
+    task_names: Iterable[str],
+    priority: int = 0,
+    run_at: datetime.datetime | None = None,
+    batch_size: int = 1000,
+) -> list[TaskQueue]:
+    # Вставка пачками по batch_size строк вместо INSERT на каждую задачу
+    run_at = run_at or timezone.now()
+    with transaction.atomic():
+        tasks = TaskQueue.objects.bulk_create(
+            [
+                TaskQueue(task_name=task_name, priority=priority, run_at=run_at)
+                for task_name in task_names
+            ],
+            batch_size=batch_size,
+        )
+        notify()
+    return tasks
+
+
+def enqueue(
+    task_name: str, priority: int = 0, run_at: datetime.datetime | None = None
+) -> TaskQueue:
+    return enqueue_many([task_name], priority, run_at)[0]
 
 
 @transaction.atomic
-def fetch_task():
-    task = (
+def fetch_tasks(n: int, lease: datetime.timedelta = DEFAULT_LEASE) -> list[TaskQueue]:
+    now = timezone.now()
+    # Порядок совпадает с индексом (status, -priority, run_at)
+    tasks = list(
         TaskQueue.objects.select_for_update(skip_locked=True)
-        .filter(status="pending")
-        .order_by("created_at")
-        .first()
+        .filter(status="pending", run_at__lte=now)
+        .order_by("-priority", "run_at")[:n]
     )
 
-    if task is None:
-        return None
+    if not tasks:
+        return []
+
+    # Один UPDATE на всю пачку вместо save() на каждую задачу
+    lease_expires_at = now + lease
+    TaskQueue.objects.filter(pk__in=[task.pk for task in tasks]).update(
+        status="in_progress",
+        lease_expires_at=lease_expires_at,
+        attempts=F("attempts") + 1,
+        updated_at=now,
+    )
+
+    for task in tasks:
+        task.status = "in_progress"
+        task.lease_expires_at = lease_expires_at
+        task.attempts += 1
+        task.updated_at = now
+
+    return tasks
+
+
+def fetch_task(lease: datetime.timedelta = DEFAULT_LEASE):
+    tasks = fetch_tasks(1, lease)
+    return tasks[0] if tasks else None
+
+
+def _claimed(tasks: list[TaskQueue]) -> QuerySet:
+    # Строки, которые всё ещё принадлежат этому захвату. Пока воркер работал,
+    # аренда могла истечь, а задача - вернуться в очередь или достаться
+    # другому воркеру. Каждый захват увеличивает attempts, поэтому значение
+    # из fetch_tasks() служит токеном захвата
+    by_attempts = defaultdict(list)
+    for task in tasks:
+        by_attempts[task.attempts].append(task.pk)
+    condition = Q()
+    for attempts, ids in by_attempts.items():
+        condition |= Q(pk__in=ids, attempts=attempts)
+    return TaskQueue.objects.filter(condition, status="in_progress")
+
+
+def heartbeat(tasks: list[TaskQueue], lease: datetime.timedelta = DEFAULT_LEASE) -> int:
+    # Продлевает аренду задач, которые воркер ещё выполняет
+    if not tasks:
+        return 0
+    now = timezone.now()
+    return _claimed(tasks).update(lease_expires_at=now + lease, updated_at=now)
+
+
+def requeue_expired(max_attempts: int = MAX_ATTEMPTS) -> tuple[int, int]:
+    # Оба UPDATE идут по индексу (status, lease_expires_at) как range scan
+    now = timezone.now()
+    expired = TaskQueue.objects.filter(status="in_progress", lease_expires_at__lt=now)
+
+    dead = expired.filter(attempts__gte=max_attempts).update(
+        status="dead", lease_expires_at=None, updated_at=now
+    )
+    requeued = expired.filter(attempts__lt=max_attempts).update(
+        status="pending", lease_expires_at=None, updated_at=now
+    )
+    if requeued:
+        notify()
+
+    return requeued, dead
+
+
+def _set_status(tasks: list[TaskQueue], status: str, **fields) -> int:
+    # Задачи, которые воркер уже потерял, не трогаем: их статус пишет
+    # новый владелец или reaper
+    if not tasks:
+        return 0
+    return _claimed(tasks).update(
+        status=status, lease_expires_at=None, updated_at=timezone.now(), **fields
+    )
+
+
+def complete_tasks(tasks: list[TaskQueue]) -> int:
+    return _set_status(tasks, "done")
+
+
+def fail_tasks(tasks: list[TaskQueue]) -> int:
+    return _set_status(tasks, "failed")
 
-    task.status = "in_progress"
-    task.save()
 
-    return task
+def release_tasks(tasks: list[TaskQueue]) -> int:
+    # Возвращает захваченные, но не начатые задачи обратно в очередь,
+    # не засчитывая попытку
+    released = _set_status(tasks, "pending", attempts=F("attempts") - 1)
+    if released:
+        notify()
+    return released
@@ -1 +1,127 @@
-# Create your tests here.
+import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+
+from .models import TaskQueue
+from .service import (
+    complete_tasks,
+    enqueue,
+    enqueue_many,
+    fail_tasks,
+    fetch_tasks,
+    heartbeat,
+    release_tasks,
+    requeue_expired,
+)
+
+
+def expire(tasks):
+    # Аренда истекла, как будто воркер завис или упал
+    past = timezone.now() - datetime.timedelta(seconds=1)
+    TaskQueue.objects.filter(pk__in=[t.pk for t in tasks]).update(lease_expires_at=past)
+
+
+class FetchTasksTests(TestCase):
+    def test_batch_order_priority_then_run_at(self):
+        now = timezone.now()
+        enqueue("old", run_at=now - datetime.timedelta(minutes=2))
+        enqueue("new", run_at=now - datetime.timedelta(minutes=1))
+        enqueue("urgent", priority=10)
+        enqueue("later", run_at=now + datetime.timedelta(hours=1))
+
+        tasks = fetch_tasks(10)
+
+        self.assertEqual([t.task_name for t in tasks], ["urgent", "old", "new"])
+        self.assertEqual(fetch_tasks(10), [])
+
+    def test_claim_marks_batch_in_progress(self):
+        enqueue_many(["a", "b", "c"])
+
+        tasks = fetch_tasks(2)
+
+        self.assertEqual(len(tasks), 2)
+        for task in tasks:
+            task.refresh_from_db()
+            self.assertEqual(task.status, "in_progress")
+            self.assertEqual(task.attempts, 1)
+            self.assertGreater(task.lease_expires_at, timezone.now())
+        self.assertEqual(TaskQueue.objects.filter(status="pending").count(), 1)
+
+
+class LeaseTests(TestCase):
+    def test_heartbeat_extends_lease(self):
+        enqueue("a")
+        tasks = fetch_tasks(1, datetime.timedelta(seconds=1))
+        expire(tasks)
+
+        self.assertEqual(heartbeat(tasks, datetime.timedelta(minutes=5)), 1)
+
+        self.assertEqual(requeue_expired(), (0, 0))
+        task = TaskQueue.objects.get()
+        self.assertGreater(
+            task.lease_expires_at, timezone.now() + datetime.timedelta(minutes=4)
+        )
+
+    def test_requeue_expired_returns_tasks_to_pending(self):
+        enqueue_many(["a", "b"])
+        expired, active = fetch_tasks(2)
+        expire([expired])
+
+        self.assertEqual(requeue_expired(), (1, 0))
+
+        expired.refresh_from_db()
+        active.refresh_from_db()
+        self.assertEqual(expired.status, "pending")
+        self.assertIsNone(expired.lease_expires_at)
+        self.assertEqual(active.status, "in_progress")
+        self.assertEqual(fetch_tasks(1)[0].attempts, 2)
+
+    def test_dead_letter_after_max_attempts(self):
+        enqueue("a")
+        for _ in range(3):
+            expire(fetch_tasks(1))
+            requeue_expired(max_attempts=3)
+
+        task = TaskQueue.objects.get()
+        self.assertEqual(task.status, "dead")
+        self.assertEqual(task.attempts, 3)
+        self.assertEqual(fetch_tasks(1), [])
+
+
+class StaleClaimTests(TestCase):
+    # Воркер, потерявший аренду, не должен менять чужие задачи
+    def test_complete_after_reclaim_is_ignored(self):
+        enqueue("a")
+        stale = fetch_tasks(1)
+        expire(stale)
+        requeue_expired()
+        current = fetch_tasks(1)
+
+        self.assertEqual(complete_tasks(stale), 0)
+        self.assertEqual(fail_tasks(stale), 0)
+        self.assertEqual(heartbeat(stale), 0)
+        self.assertEqual(TaskQueue.objects.get().status, "in_progress")
+
+        self.assertEqual(complete_tasks(current), 1)
+        self.assertEqual(TaskQueue.objects.get().status, "done")
+
+    def test_release_after_requeue_keeps_attempts(self):
+        enqueue("a")
+        stale = fetch_tasks(1)
+        expire(stale)
+        requeue_expired()
+
+        self.assertEqual(release_tasks(stale), 0)
+
+        task = TaskQueue.objects.get()
+        self.assertEqual((task.status, task.attempts), ("pending", 1))
+
+    def test_release_returns_attempt(self):
+        enqueue("a")
+        tasks = fetch_tasks(1)
+
+        self.assertEqual(release_tasks(tasks), 1)
+
+        task = TaskQueue.objects.get()
+        self.assertEqual((task.status, task.attempts), ("pending", 0))
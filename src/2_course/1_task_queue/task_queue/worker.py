@@ -0,0 +1,211 @@
+import datetime
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from typing import Callable
+
+from django.db import DatabaseError, connections
+
+from .models import TaskQueue
+from .notify import Listener, is_postgres
+from .service import (
+    DEFAULT_LEASE,
+    MAX_ATTEMPTS,
+    complete_tasks,
+    fail_tasks,
+    fetch_tasks,
+    heartbeat,
+    release_tasks,
+    requeue_expired,
+)
+
+logger = logging.getLogger(__name__)
+
+handlers: dict[str, Callable] = {}
+
+# Потомки наследуют от родителя настроенный Django и реестр handlers, поэтому
+# процессы создаются только через fork. При spawn и forkserver (по умолчанию
+# на Linux с Python 3.14) импорт моделей в потомке падает с AppRegistryNotReady
+mp_context = multiprocessing.get_context("fork")
+
+
+def register(name: str | None = None):
+    def decorator(func: Callable) -> Callable:
+        handlers[name or func.__name__] = func
+        return func
+
+    return decorator
+
+
+class Worker:
+    def __init__(
+        self,
+        stop_event,
+        batch_size: int = 10,
+        min_sleep: float = 0.05,
+        max_sleep: float = 2.0,
+        lease: datetime.timedelta = DEFAULT_LEASE,
+    ):
+        self.stop_event = stop_event
+        self.batch_size = batch_size
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.lease = lease
+        self.current_tasks: list[TaskQueue] = []
+        # Выставляется обработчиком сигнала. Сам stop_event из обработчика
+        # трогать нельзя: его блокировка может быть уже захвачена в wait()
+        self.stopping = False
+        self._stopped = threading.Event()
+        self.listener = Listener() if is_postgres() else None
+
+    def should_stop(self) -> bool:
+        return self.stopping or self.stop_event.is_set()
+
+    def _heartbeat_loop(self) -> None:
+        # Продлеваем аренду текущей пачки в фоне, пока выполняются
+        # долгие обработчики
+        interval = self.lease.total_seconds() / 3
+        try:
+            while not self._stopped.wait(interval):
+                tasks = self.current_tasks
+                if tasks:
+                    try:
+                        heartbeat(tasks, self.lease)
+                    except DatabaseError:
+                        logger.exception("Heartbeat failed")
+        finally:
+            connections.close_all()
+
+    def run(self) -> None:
+        heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat_thread.start()
+        try:
+            self._run()
+        finally:
+            self._stopped.set()
+            heartbeat_thread.join()
+
+    def _run(self) -> None:
+        sleep = self.min_sleep
+        while not self.should_stop():
+            try:
+                processed = self.run_once()
+            except DatabaseError:
+                # Например, "database is locked" на SQLite: не падаем,
+                # а повторяем попытку после паузы
+                logger.exception("Worker %s failed to fetch tasks", os.getpid())
+                processed = 0
+
+            if processed:
+                sleep = self.min_sleep
+                continue
+
+            # Очередь пуста: ждём с экспоненциальной задержкой. На Postgres
+            # просыпаемся сразу по NOTIFY о новых задачах, иначе - по сигналу
+            # остановки
+            if self.listener is not None:
+                try:
+                    self.listener.wait(sleep)
+                except DatabaseError:
+                    logger.exception("Worker %s failed to LISTEN", os.getpid())
+                    self.stop_event.wait(sleep)
+            else:
+                self.stop_event.wait(sleep)
+            sleep = min(sleep * 2, self.max_sleep)
+
+    def run_once(self) -> int:
+        tasks = fetch_tasks(self.batch_size, self.lease)
+        done, failed = [], []
+        # Аренду продлеваем всей пачке, пока статусы не записаны в базу
+        self.current_tasks = tasks
+
+        for i, task in enumerate(tasks):
+            if self.should_stop():
+                release_tasks(tasks[i:])
+                break
+
+            handler = handlers.get(task.task_name)
+            if handler is None:
+                logger.error("No handler registered for task %r", task.task_name)
+                failed.append(task)
+                continue
+
+            try:
+                handler(task)
+            except Exception:
+                logger.exception("Task %s (%s) failed", task.pk, task.task_name)
+                failed.append(task)
+            else:
+                done.append(task)
+
+        self.current_tasks = []
+        complete_tasks(done)
+        fail_tasks(failed)
+
+        return len(tasks)
+
+
+def _worker_main(stop_event, options: dict) -> None:
+    # Процесс-потомок не должен пользоваться соединениями родителя
+    connections.close_all()
+    worker = Worker(stop_event, **options)
+
+    def shutdown(signum, frame):
+        worker.stopping = True
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logger.info("Worker %s started", os.getpid())
+    try:
+        worker.run()
+    finally:
+        connections.close_all()
+        logger.info("Worker %s stopped", os.getpid())
+
+
+def run_pool(
+    processes: int,
+    reap_interval: float = 5.0,
+    max_attempts: int = MAX_ATTEMPTS,
+    **options,
+) -> None:
+    stop_event = mp_context.Event()
+    stopping = False
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    connections.close_all()
+    workers = [
+        mp_context.Process(target=_worker_main, args=(stop_event, options))
+        for _ in range(processes)
+    ]
+    for p in workers:
+        p.start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Родитель работает reaper'ом: возвращает в очередь задачи упавших воркеров
+    next_reap = 0.0
+    while not stopping and any(p.is_alive() for p in workers):
+        if time.monotonic() >= next_reap:
+            try:
+                requeued, dead = requeue_expired(max_attempts)
+            except DatabaseError:
+                logger.exception("Reaper failed")
+            else:
+                if requeued or dead:
+                    logger.warning("Reaper: %s requeued, %s dead", requeued, dead)
+            next_reap = time.monotonic() + reap_interval
+        time.sleep(0.5)
+
+    stop_event.set()
+    for p in workers:
+        p.join()
+    connections.close_all()
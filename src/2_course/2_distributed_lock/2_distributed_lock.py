@@ -1,42 +1,279 @@
+import asyncio
+import contextvars
 import datetime
 import functools
+import inspect
+import threading
 import time
 from uuid import uuid4
 
 import redis
+import redis.asyncio
 
 r = redis.Redis(host="localhost", port=6379, db=0)
 
+# Захват и выдача fencing-токена одной атомарной операцией. Токен растёт
+# монотонно для каждой функции: хранилище, в которое пишет владелец
+# блокировки, может отвергать записи со старым токеном от процесса,
+# чья аренда уже истекла. Счётчик один на функцию, а не на ключ блокировки:
+# с key="{user_id}" иначе в Redis навсегда оставалось бы по ключу на
+# каждое значение аргумента
+ACQUIRE_SCRIPT = """
+if redis.call("set", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    return redis.call("incr", KEYS[2])
+else
+    return 0
+end
+"""
+
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    redis.call("del", KEYS[1])
+    redis.call("publish", KEYS[2], "released")
+    return 1
+else
+    return 0
+end
+"""
+
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+
+# Скрипты регистрируются один раз и вызываются через EVALSHA. Объект Script
+# можно вызвать и на другом клиенте через client=
+acquire_script = r.register_script(ACQUIRE_SCRIPT)
+release_script = r.register_script(RELEASE_SCRIPT)
+renew_script = r.register_script(RENEW_SCRIPT)
+
+# Блокировки, которые держит текущий поток (или asyncio-задача), с их
+# fencing-токенами: повторный вход в ту же блокировку не ждёт сам себя
+_held = threading.local()
+_held_async: contextvars.ContextVar[dict] = contextvars.ContextVar("held_locks")
+
+
+def _held_keys() -> dict:
+    if not hasattr(_held, "keys"):
+        _held.keys = {}
+    return _held.keys
+
+
+def _make_key(func, key, args, kwargs) -> str:
+    if key is None:
+        return f"lock:{func.__name__}"
+    if callable(key):
+        return f"lock:{func.__name__}:{key(*args, **kwargs)}"
+
+    # Строка-шаблон по аргументам функции, например "{user_id}"
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return f"lock:{func.__name__}:{key.format(**bound.arguments)}"
+
+
+def _fence_key(func) -> str:
+    return f"fence:{func.__name__}"
+
+
+def _wait_timeout(blocking: bool, timeout: float | None) -> float | None:
+    if not blocking:
+        return None
+    return timeout if timeout is not None else float("inf")
+
+
+def _with_token(func, kwargs: dict, token: int) -> dict:
+    # Функция получает токен, если объявила параметр fencing_token
+    if "fencing_token" in inspect.signature(func).parameters:
+        return {**kwargs, "fencing_token": token}
+    return kwargs
+
+
+def _acquire(client, lock_key, fence_key, lock_id, ttl_ms, timeout) -> int:
+    keys, args = [lock_key, fence_key], [lock_id, ttl_ms]
+
+    token = acquire_script(keys=keys, args=args, client=client)
+    if token or timeout is None:
+        return token
+
+    # Ждём сообщения об освобождении вместо опроса. Подписываемся до
+    # повторной попытки, чтобы не пропустить publish между ними
+    deadline = time.monotonic() + timeout
+    with client.pubsub(ignore_subscribe_messages=True) as pubsub:
+        pubsub.subscribe(f"{lock_key}:released")
+        while True:
+            token = acquire_script(keys=keys, args=args, client=client)
+            if token:
+                return token
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return 0
+
+            # Если владелец упал, publish не придёт: ждём не дольше,
+            # чем осталось жить ключу
+            pttl = client.pttl(lock_key)
+            wait = min(remaining, pttl / 1000) if pttl > 0 else 0
+            pubsub.get_message(timeout=wait)
+
+
+def _watchdog(client, lock_key, lock_id, ttl_ms, stop: threading.Event):
+    # Продлеваем аренду на треть срока раньше её окончания
+    while not stop.wait(ttl_ms / 3000):
+        if not renew_script(keys=[lock_key], args=[lock_id, ttl_ms], client=client):
+            return
+
+
+def single(
+    max_processing_time: datetime.timedelta,
+    *,
+    key=None,
+    blocking: bool = False,
+    timeout: float | None = None,
+    renew: bool = True,
+    connection_pool: redis.ConnectionPool | None = None,
+):
+    ttl_ms = int(max_processing_time.total_seconds() * 1000)
+    client = redis.Redis(connection_pool=connection_pool) if connection_pool else r
 
-def single(max_processing_time: datetime.timedelta):
     def decorator(func):
+        fence_key = _fence_key(func)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            lock_key = f"lock:{func.__name__}"
+            lock_key = _make_key(func, key, args, kwargs)
+            held = _held_keys()
+
+            if lock_key in held:
+                return func(*args, **_with_token(func, kwargs, held[lock_key]))
+
             lock_id = str(uuid4())
+            wait = _wait_timeout(blocking, timeout)
+            token = _acquire(client, lock_key, fence_key, lock_id, ttl_ms, wait)
+            if not token:
+                print(f"Функция {func.__name__} уже выполняется на другом сервере.")
+                return None
 
-            acquired = r.set(
-                lock_key,
-                lock_id,
-                nx=True,
-                px=int(max_processing_time.total_seconds() * 1000),
-            )
+            stop = threading.Event()
+            if renew:
+                threading.Thread(
+                    target=_watchdog,
+                    args=(client, lock_key, lock_id, ttl_ms, stop),
+                    daemon=True,
+                ).start()
+
+            held[lock_key] = token
+            try:
+                return func(*args, **_with_token(func, kwargs, token))
+            finally:
+                del held[lock_key]
+                stop.set()
+                release_script(
+                    keys=[lock_key, f"{lock_key}:released"],
+                    args=[lock_id],
+                    client=client,
+                )
+
+        return wrapper
+
+    return decorator
+
+
+async def _acquire_async(
+    client, scripts, lock_key, fence_key, lock_id, ttl_ms, timeout
+) -> int:
+    keys, args = [lock_key, fence_key], [lock_id, ttl_ms]
+
+    token = await scripts["acquire"](keys=keys, args=args)
+    if token or timeout is None:
+        return token
 
-            if not acquired:
+    deadline = time.monotonic() + timeout
+    async with client.pubsub(ignore_subscribe_messages=True) as pubsub:
+        await pubsub.subscribe(f"{lock_key}:released")
+        while True:
+            token = await scripts["acquire"](keys=keys, args=args)
+            if token:
+                return token
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return 0
+
+            pttl = await client.pttl(lock_key)
+            wait = min(remaining, pttl / 1000) if pttl > 0 else 0
+            await pubsub.get_message(timeout=wait)
+
+
+async def _watchdog_async(scripts, lock_key, lock_id, ttl_ms):
+    while True:
+        await asyncio.sleep(ttl_ms / 3000)
+        if not await scripts["renew"](keys=[lock_key], args=[lock_id, ttl_ms]):
+            return
+
+
+def async_single(
+    max_processing_time: datetime.timedelta,
+    *,
+    key=None,
+    blocking: bool = False,
+    timeout: float | None = None,
+    renew: bool = True,
+    connection_pool: redis.asyncio.ConnectionPool | None = None,
+):
+    # Версия single для async def функций поверх redis.asyncio. Пул
+    # соединений передаётся снаружи, например общий для всего приложения
+    ttl_ms = int(max_processing_time.total_seconds() * 1000)
+    client = redis.asyncio.Redis(connection_pool=connection_pool)
+    scripts = {
+        "acquire": client.register_script(ACQUIRE_SCRIPT),
+        "release": client.register_script(RELEASE_SCRIPT),
+        "renew": client.register_script(RENEW_SCRIPT),
+    }
+
+    def decorator(func):
+        fence_key = _fence_key(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            lock_key = _make_key(func, key, args, kwargs)
+            held = _held_async.get({})
+
+            # Задачи, созданные внутри функции, получают копию контекста:
+            # повторным входом считается только вызов из той же задачи
+            owner, held_token = held.get(lock_key, (None, 0))
+            if owner is asyncio.current_task():
+                return await func(*args, **_with_token(func, kwargs, held_token))
+
+            lock_id = str(uuid4())
+            wait = _wait_timeout(blocking, timeout)
+            token = await _acquire_async(
+                client, scripts, lock_key, fence_key, lock_id, ttl_ms, wait
+            )
+            if not token:
                 print(f"Функция {func.__name__} уже выполняется на другом сервере.")
                 return None
 
+            watchdog = None
+            if renew:
+                watchdog = asyncio.create_task(
+                    _watchdog_async(scripts, lock_key, lock_id, ttl_ms)
+                )
+
+            reset = _held_async.set(
+                {**held, lock_key: (asyncio.current_task(), token)}
+            )
             try:
-                return func(*args, **kwargs)
+                return await func(*args, **_with_token(func, kwargs, token))
             finally:
-                release_script = """
-                if redis.call("get", KEYS[1]) == ARGV[1] then
-                    return redis.call("del", KEYS[1])
-                else
-                    return 0
-                end
-                """
-                r.eval(release_script, 1, lock_key, lock_id)
+                _held_async.reset(reset)
+                if watchdog is not None:
+                    watchdog.cancel()
+                await scripts["release"](
+                    keys=[lock_key, f"{lock_key}:released"], args=[lock_id]
+                )
 
         return wrapper
 
@@ -48,3 +285,111 @@ def process_transaction(minutes):
     print("Начинаем обработку транзакции...")
     time.sleep(minutes)
     print("Транзакция обработана!")
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Аренда 300 мс продлевается, пока функция работает секунду
+    @single(max_processing_time=datetime.timedelta(milliseconds=300))
+    def long_job():
+        time.sleep(1)
+        return "done"
+
+    with ThreadPoolExecutor() as executor:
+        first = executor.submit(long_job)
+        time.sleep(0.5)
+        assert long_job() is None
+        assert first.result() == "done"
+
+    # Блокирующий захват дожидается освобождения по pub/sub
+    @single(max_processing_time=datetime.timedelta(seconds=5), blocking=True)
+    def short_job(i):
+        time.sleep(0.1)
+        return i
+
+    with ThreadPoolExecutor() as executor:
+        assert sorted(executor.map(short_job, range(5))) == [0, 1, 2, 3, 4]
+
+    # Разные аргументы - разные блокировки, вызовы не ждут друг друга
+    @single(max_processing_time=datetime.timedelta(seconds=5), key="{user_id}")
+    def per_user(user_id):
+        time.sleep(0.3)
+        return user_id
+
+    with ThreadPoolExecutor() as executor:
+        start = time.perf_counter()
+        assert list(executor.map(per_user, [1, 2, 3])) == [1, 2, 3]
+        assert time.perf_counter() - start < 0.6
+    # После освобождения от вызовов не остаётся ключей по аргументам
+    assert not r.keys("*per_user:*")
+
+    # Повторный вход из того же потока
+    @single(max_processing_time=datetime.timedelta(seconds=5))
+    def recursive(n):
+        return n if n == 0 else recursive(n - 1)
+
+    assert recursive(3) == 0
+
+    # Каждый захват получает токен больше предыдущего
+    @single(max_processing_time=datetime.timedelta(seconds=5))
+    def fenced(fencing_token):
+        return fencing_token
+
+    first_token = fenced()
+    assert fenced() == first_token + 1
+
+    async def check_async():
+        pool = redis.asyncio.ConnectionPool()
+
+        @async_single(
+            max_processing_time=datetime.timedelta(milliseconds=300),
+            connection_pool=pool,
+        )
+        async def long_job_async(fencing_token):
+            await asyncio.sleep(1)
+            return fencing_token
+
+        first = asyncio.create_task(long_job_async())
+        await asyncio.sleep(0.5)
+        assert await long_job_async() is None
+        assert await first is not None
+
+        @async_single(
+            max_processing_time=datetime.timedelta(seconds=5),
+            blocking=True,
+            connection_pool=pool,
+        )
+        async def short_job_async(i, fencing_token):
+            await asyncio.sleep(0.1)
+            return fencing_token
+
+        tokens = await asyncio.gather(*(short_job_async(i) for i in range(5)))
+        # Счётчик токенов живёт в Redis между запусками: проверяем, что
+        # пять захватов подряд получили пять последовательных токенов
+        assert sorted(tokens) == list(range(min(tokens), min(tokens) + 5))
+
+        # Задачи, порождённые под блокировкой, не наследуют её из контекста
+        @async_single(
+            max_processing_time=datetime.timedelta(seconds=5), connection_pool=pool
+        )
+        async def spawner(spawn):
+            if not spawn:
+                return "child"
+            return await asyncio.gather(
+                *(asyncio.create_task(spawner(False)) for _ in range(3))
+            )
+
+        assert await spawner(True) == [None, None, None]
+
+        @async_single(
+            max_processing_time=datetime.timedelta(seconds=5), connection_pool=pool
+        )
+        async def recursive_async(n):
+            return n if n == 0 else await recursive_async(n - 1)
+
+        assert await recursive_async(3) == 0
+
+        await pool.aclose()
+
+    asyncio.run(check_async())
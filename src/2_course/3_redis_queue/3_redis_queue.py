@@ -1,24 +1,392 @@
 import json
+import marshal
+import threading
+import time
+import zlib
+from uuid import uuid4
 
 import redis
 
+try:
+    import msgpack
+except ModuleNotFoundError:
+    msgpack = None
+
+
+class JsonSerializer:
+    name = "json"
+
+    def dumps(self, msg) -> bytes:
+        return json.dumps(msg, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+class MarshalSerializer:
+    # Быстрый, но формат зависит от версии Python: публикующие и читающие
+    # процессы должны работать на одной версии
+    name = "marshal"
+
+    def dumps(self, msg) -> bytes:
+        return marshal.dumps(msg)
+
+    def loads(self, data: bytes):
+        return marshal.loads(data)
+
+
+class MsgpackSerializer:
+    # Включается явно через serializer=: формат на проводе не должен зависеть
+    # от того, установлен ли msgpack в конкретном процессе
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ModuleNotFoundError("msgpack is not installed")
+
+    def dumps(self, msg) -> bytes:
+        return msgpack.packb(msg, use_bin_type=True)
+
+    def loads(self, data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+
+class CompressedSerializer:
+    # Сжимает только крупные сообщения; первый байт - флаг сжатия
+    def __init__(self, serializer, threshold=1024, level=1):
+        self.serializer = serializer
+        self.threshold = threshold
+        self.level = level
+        self.name = f"{serializer.name}+zlib"
+
+    def dumps(self, msg) -> bytes:
+        data = self.serializer.dumps(msg)
+        if len(data) < self.threshold:
+            return b"\x00" + data
+        return b"\x01" + zlib.compress(data, self.level)
+
+    def loads(self, data: bytes):
+        if data[:1] == b"\x01":
+            return self.serializer.loads(zlib.decompress(data[1:]))
+        return self.serializer.loads(data[1:])
+
+
+def default_serializer():
+    # json есть везде и читает сообщения, поставленные до появления
+    # сериализаторов. Публикующие и читающие процессы должны использовать
+    # один сериализатор
+    return JsonSerializer()
+
 
 class RedisQueue:
-    def __init__(self, name="redis_queue", host="localhost", port=6379, db=0):
+    def __init__(
+        self,
+        name="redis_queue",
+        host="localhost",
+        port=6379,
+        db=0,
+        chunk_size=1000,
+        serializer=None,
+    ):
         self.name = name
-        self.r = redis.Redis(host=host, port=port, db=db, decode_responses=True)
+        self.chunk_size = chunk_size
+        self.serializer = serializer or default_serializer()
+        # Сообщения хранятся и передаются как bytes, без декодирования UTF-8
+        self.r = redis.Redis(host=host, port=port, db=db)
 
     def publish(self, msg: dict) -> None:
-        data = json.dumps(msg)
+        data = self.serializer.dumps(msg)
         self.r.rpush(self.name, data)
 
-    def consume(self) -> dict:
-        data = json.loads(self.r.lpop(self.name))
-        return data if data is not None else None
+    def publish_many(self, msgs: list[dict]) -> None:
+        # Один RPUSH на chunk_size сообщений, все чанки - одним пайплайном
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(msgs), self.chunk_size):
+            chunk = msgs[i : i + self.chunk_size]
+            pipe.rpush(self.name, *(self.serializer.dumps(msg) for msg in chunk))
+        pipe.execute()
+
+    def consume(self, timeout: float | None = None) -> dict | None:
+        # timeout=None - не ждать, timeout=0 - ждать бесконечно
+        if timeout is None:
+            data = self.r.lpop(self.name)
+        else:
+            item = self.r.blpop([self.name], timeout=timeout)
+            data = item[1] if item is not None else None
+
+        return self.serializer.loads(data) if data is not None else None
+
+    def consume_many(self, n: int) -> list[dict]:
+        data = self.r.lpop(self.name, n)
+        if data is None:
+            return []
+        return [self.serializer.loads(item) for item in data]
+
+
+class ReliableRedisQueue(RedisQueue):
+    # At-least-once доставка: сообщение атомарно переносится в личный
+    # processing-список потребителя и удаляется оттуда только после ack.
+    # Сообщения умерших потребителей возвращает в очередь recover().
+    # Живость потребителя - ключ heartbeat, который продлевает фоновый поток
+    # с первого consume() и до close(): ни долгое ожидание в BLMOVE, ни долгая
+    # обработка сообщения не делают потребителя "умершим"
+    def __init__(
+        self, name="redis_queue", consumer_id=None, heartbeat_ttl=30, **kwargs
+    ):
+        super().__init__(name, **kwargs)
+        self.consumer_id = consumer_id or str(uuid4())
+        self.heartbeat_ttl = heartbeat_ttl
+        self.consumers_key = f"{name}:consumers"
+        self.processing = self._processing_key(self.consumer_id)
+        self.heartbeat_key = self._heartbeat_key(self.consumer_id)
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def _processing_key(self, consumer_id: str) -> str:
+        return f"{self.name}:processing:{consumer_id}"
+
+    def _heartbeat_key(self, consumer_id: str) -> str:
+        return f"{self.name}:heartbeat:{consumer_id}"
+
+    def _pipeline_with_heartbeat(self):
+        # Продление heartbeat уходит тем же round trip, что и чтение
+        pipe = self.r.pipeline(transaction=False)
+        pipe.set(self.heartbeat_key, 1, ex=self.heartbeat_ttl)
+        # recover() мог посчитать потребителя умершим и убрать из множества -
+        # каждое продление регистрирует его заново
+        pipe.sadd(self.consumers_key, self.consumer_id)
+        return pipe
+
+    def _heartbeat_loop(self) -> None:
+        while True:
+            try:
+                self._pipeline_with_heartbeat().execute()
+            except redis.RedisError:
+                # Повторим на следующем такте, запас - два пропуска до TTL
+                pass
+            if self._heartbeat_stop.wait(self.heartbeat_ttl / 3):
+                return
+
+    def start_heartbeat(self) -> None:
+        if self._heartbeat_thread is not None:
+            return
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(
+            target=self._heartbeat_loop, daemon=True
+        )
+        self._heartbeat_thread.start()
+
+    def close(self) -> None:
+        # Останавливает heartbeat: через heartbeat_ttl recover() вернёт
+        # неподтверждённые сообщения в очередь
+        self._heartbeat_stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def __enter__(self):
+        self.start_heartbeat()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def consume(self, timeout: float | None = None) -> tuple[bytes, dict] | None:
+        self.start_heartbeat()
+        if timeout is None:
+            pipe = self._pipeline_with_heartbeat()
+            pipe.lmove(self.name, self.processing, "LEFT", "RIGHT")
+            data = pipe.execute()[-1]
+        else:
+            # Блокирующее ожидание режем на отрезки короче heartbeat_ttl,
+            # продлевая heartbeat перед каждым; timeout=0 - ждать бесконечно
+            deadline = time.monotonic() + timeout if timeout else None
+            while True:
+                block = self.heartbeat_ttl / 2
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        data = None
+                        break
+                    block = min(block, remaining)
+                pipe = self._pipeline_with_heartbeat()
+                pipe.blmove(self.name, self.processing, block, "LEFT", "RIGHT")
+                data = pipe.execute()[-1]
+                if data is not None:
+                    break
+
+        return (data, self.serializer.loads(data)) if data is not None else None
+
+    def consume_many(self, n: int) -> list[tuple[bytes, dict]]:
+        self.start_heartbeat()
+        pipe = self._pipeline_with_heartbeat()
+        for _ in range(n):
+            pipe.lmove(self.name, self.processing, "LEFT", "RIGHT")
+        data = pipe.execute()[2:]
+
+        return [
+            (item, self.serializer.loads(item)) for item in data if item is not None
+        ]
+
+    def ack(self, data: bytes) -> None:
+        self.r.lrem(self.processing, 1, data)
+
+    def nack(self, data: bytes) -> None:
+        # Возвращаем сообщение в конец очереди одной транзакцией
+        pipe = self.r.pipeline()
+        pipe.lrem(self.processing, 1, data)
+        pipe.rpush(self.name, data)
+        pipe.execute()
+
+    def recover(self) -> int:
+        recovered = 0
+        for member in self.r.smembers(self.consumers_key):
+            consumer_id = member.decode()
+            if self.r.exists(self._heartbeat_key(consumer_id)):
+                continue
+
+            # Переносим с правого конца processing в голову очереди, чтобы
+            # сохранить исходный порядок сообщений
+            processing = self._processing_key(consumer_id)
+            while self.r.lmove(processing, self.name, "RIGHT", "LEFT") is not None:
+                recovered += 1
+            self.r.srem(self.consumers_key, member)
+
+        return recovered
+
+
+class RedisStreamQueue(RedisQueue):
+    # Очередь на Redis Streams: каждая группа потребителей читает поток
+    # независимо и хранит свою позицию, поэтому несколько групп воркеров
+    # могут читать одни и те же сообщения параллельно
+    def __init__(
+        self,
+        name="redis_stream",
+        group="default",
+        consumer_id=None,
+        maxlen=100_000,
+        start_id="0",
+        **kwargs,
+    ):
+        super().__init__(name, **kwargs)
+        self.group = group
+        self.consumer_id = consumer_id or str(uuid4())
+        self.maxlen = maxlen
+
+        try:
+            self.r.xgroup_create(name, group, id=start_id, mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _xadd(self, client, msg: dict) -> None:
+        # Приблизительная обрезка (MAXLEN ~) дешевле точной
+        client.xadd(
+            self.name,
+            {"data": self.serializer.dumps(msg)},
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+
+    def publish(self, msg: dict) -> None:
+        self._xadd(self.r, msg)
+
+    def publish_many(self, msgs: list[dict]) -> None:
+        pipe = self.r.pipeline(transaction=False)
+        for msg in msgs:
+            self._xadd(pipe, msg)
+        pipe.execute()
+
+    def _read(self, count: int, timeout: float | None) -> list[tuple[bytes, dict]]:
+        block = int(timeout * 1000) if timeout is not None else None
+        response = self.r.xreadgroup(
+            self.group, self.consumer_id, {self.name: ">"}, count=count, block=block
+        )
+        if not response:
+            return []
+
+        _, entries = response[0]
+        return [
+            (entry_id, self.serializer.loads(fields[b"data"]))
+            for entry_id, fields in entries
+        ]
+
+    def consume(self, timeout: float | None = None) -> tuple[bytes, dict] | None:
+        entries = self._read(1, timeout)
+        return entries[0] if entries else None
+
+    def consume_many(
+        self, n: int, timeout: float | None = None
+    ) -> list[tuple[bytes, dict]]:
+        return self._read(n, timeout)
+
+    def ack(self, *entry_ids: bytes) -> int:
+        return self.r.xack(self.name, self.group, *entry_ids)
+
+    def claim_stalled(
+        self, min_idle_time: int = 30_000, count: int = 100
+    ) -> list[tuple[bytes, dict]]:
+        # Забираем себе сообщения, которые другие потребители группы
+        # получили, но не подтвердили за min_idle_time мс
+        response = self.r.xautoclaim(
+            self.name, self.group, self.consumer_id, min_idle_time, count=count
+        )
+        # Записи, уже удалённые обрезкой потока, приходят без полей
+        return [
+            (entry_id, self.serializer.loads(fields[b"data"]))
+            for entry_id, fields in response[1]
+            if fields is not None
+        ]
+
+    def consumers(self) -> list[dict]:
+        # pending - сколько сообщений потребитель получил и не подтвердил,
+        # idle - сколько мс он не читал поток
+        return self.r.xinfo_consumers(self.name, self.group)
+
+    def lag(self) -> int | None:
+        # Сколько записей группа ещё не прочитала (Redis 7+)
+        for group in self.r.xinfo_groups(self.name):
+            if group["name"].decode() == self.group:
+                return group.get("lag")
+        return None
+
+
+def benchmark_serializers(n=20_000):
+    small = {"id": 42, "event": "click", "ts": 1723.5, "ok": True}
+    large = {
+        "items": [
+            {"id": i, "name": f"item-{i}", "tags": ["a", "b"]} for i in range(200)
+        ]
+    }
+
+    serializers = [JsonSerializer(), MarshalSerializer()]
+    if msgpack is not None:
+        serializers.append(MsgpackSerializer())
+    serializers += [CompressedSerializer(serializer) for serializer in serializers]
+
+    for payload_name, payload in (("small", small), ("large", large)):
+        rounds = n if payload is small else n // 100
+        for serializer in serializers:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                data = serializer.dumps(payload)
+            encode = (time.perf_counter() - start) / rounds
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                serializer.loads(data)
+            decode = (time.perf_counter() - start) / rounds
+
+            print(
+                f"{payload_name:>5} {serializer.name:<13} {len(data):>6} bytes  "
+                f"encode {encode * 1e6:8.2f} us  decode {decode * 1e6:8.2f} us"
+            )
 
 
 if __name__ == "__main__":
     q = RedisQueue()
+    # Очередь и служебные ключи, в том числе от прерванного прогона
+    q.r.delete(q.name, *q.r.scan_iter(f"{q.name}:*"))
 
     q.publish({"a": 1})
     q.publish({"b": 2})
@@ -27,3 +395,90 @@ if __name__ == "__main__":
     assert q.consume() == {"a": 1}
     assert q.consume() == {"b": 2}
     assert q.consume() == {"c": 3}
+    assert q.consume() is None
+    assert q.consume(timeout=0.1) is None
+
+    q.publish_many([{"i": i} for i in range(5)])
+    assert q.consume(timeout=1) == {"i": 0}
+    assert q.consume_many(3) == [{"i": 1}, {"i": 2}, {"i": 3}]
+    assert q.consume_many(3) == [{"i": 4}]
+    assert q.consume_many(3) == []
+
+    rq = ReliableRedisQueue(heartbeat_ttl=1)
+    rq.publish_many([{"r": i} for i in range(4)])
+    raw, msg = rq.consume()
+    assert msg == {"r": 0}
+    rq.ack(raw)
+    raw, msg = rq.consume(timeout=1)
+    rq.nack(raw)
+    assert [msg for _, msg in rq.consume_many(2)] == [{"r": 2}, {"r": 3}]
+
+    # Потребитель жив, пока работает heartbeat, даже если обработка
+    # и ожидание в BLMOVE длятся дольше heartbeat_ttl
+    time.sleep(1.5)
+    assert ReliableRedisQueue().recover() == 0
+
+    with ReliableRedisQueue("redis_queue:idle", heartbeat_ttl=1) as idle:
+        idle.r.delete(idle.name)
+        idle.publish({"w": 1})
+        raw, _ = idle.consume()
+        assert idle.consume(timeout=1.5) is None
+        assert ReliableRedisQueue("redis_queue:idle").recover() == 0
+        idle.ack(raw)
+    idle.r.delete(idle.consumers_key)
+
+    # Потребитель "умер", не подтвердив сообщения: после истечения
+    # heartbeat они возвращаются в очередь
+    rq.close()
+    time.sleep(1.1)
+    assert ReliableRedisQueue().recover() == 2
+    assert q.consume_many(10) == [{"r": 2}, {"r": 3}, {"r": 1}]
+    q.r.delete(rq.consumers_key)
+
+    sq = RedisStreamQueue(group="workers")
+    sq.r.delete(sq.name)
+    sq = RedisStreamQueue(group="workers")
+    audit = RedisStreamQueue(group="audit")
+    sq.publish_many([{"s": i} for i in range(3)])
+
+    entry_id, msg = sq.consume(timeout=1)
+    assert msg == {"s": 0}
+    sq.ack(entry_id)
+    assert [msg for _, msg in sq.consume_many(5)] == [{"s": 1}, {"s": 2}]
+    assert sq.consume(timeout=0.1) is None
+
+    # Другая группа получает те же сообщения независимо
+    assert [msg for _, msg in audit.consume_many(5)] == [
+        {"s": 0},
+        {"s": 1},
+        {"s": 2},
+    ]
+
+    # Неподтверждённые сообщения забирает другой потребитель группы
+    other = RedisStreamQueue(group="workers")
+    assert [msg for _, msg in other.claim_stalled(min_idle_time=0)] == [
+        {"s": 1},
+        {"s": 2},
+    ]
+    sq.r.delete(sq.name)
+
+    n = 10_000
+    msgs = [{"i": i} for i in range(n)]
+
+    start = time.perf_counter()
+    for msg in msgs:
+        q.publish(msg)
+    while q.consume() is not None:
+        pass
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    q.publish_many(msgs)
+    while q.consume_many(1000):
+        pass
+    batched = time.perf_counter() - start
+
+    print(f"publish/consume: {n / single:.0f} msg/s")
+    print(f"publish_many/consume_many: {n / batched:.0f} msg/s")
+
+    benchmark_serializers()
@@ -1,14 +1,159 @@
+import asyncio
 import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from uuid import uuid4
 
 import redis
+import redis.asyncio
 
 
 class RateLimitExceed(Exception):
     pass
 
 
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    remaining: int
+    retry_after: float  # секунд до освобождения места в окне
+
+
+# Очистка окна, проверка и добавление запроса выполняются атомарно на сервере
+# за один round trip. Время берётся у Redis, чтобы не зависеть от часов клиентов
+SLIDING_WINDOW_SCRIPT = """
+local key = KEYS[1]
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local member = ARGV[3]
+
+local time = redis.call("TIME")
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+
+redis.call("ZREMRANGEBYSCORE", key, 0, now - window)
+local count = redis.call("ZCARD", key)
+
+if count >= limit then
+    local oldest = redis.call("ZRANGE", key, 0, 0, "WITHSCORES")
+    return {0, 0, tonumber(oldest[2]) + window - now}
+end
+
+redis.call("ZADD", key, now, member)
+redis.call("PEXPIRE", key, window)
+return {1, limit - count - 1, 0}
+"""
+
+# Скрипты ниже хранят O(1) состояния на ключ независимо от max_requests.
+# Дробные значения сохраняются через string.format: tostring в Lua
+# округляет до 14 значащих цифр
+
+# GCRA: храним только TAT - теоретическое время прихода следующего запроса
+GCRA_SCRIPT = """
+local key = KEYS[1]
+local period = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local interval = period / limit
+
+local time = redis.call("TIME")
+local now = time[1] * 1000 + time[2] / 1000
+
+local tat = tonumber(redis.call("GET", key)) or now
+if tat < now then
+    tat = now
+end
+
+local new_tat = tat + interval
+local allow_at = new_tat - period
+if allow_at > now then
+    return {0, 0, math.ceil(allow_at - now)}
+end
+
+redis.call("SET", key, string.format("%.3f", new_tat), "PX", math.ceil(new_tat - now))
+return {1, math.floor((now - allow_at) / interval), 0}
+"""
+
+# Token bucket: ёмкость limit, пополнение limit токенов за period.
+# ARGV[4] - сколько токенов выдать за раз (для аренды пачкой), по умолчанию 1;
+# первым элементом возвращается число выданных токенов
+TOKEN_BUCKET_SCRIPT = """
+local key = KEYS[1]
+local period = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local requested = tonumber(ARGV[4]) or 1
+
+local time = redis.call("TIME")
+local now = time[1] * 1000 + time[2] / 1000
+
+local state = redis.call("HMGET", key, "tokens", "ts")
+local tokens = tonumber(state[1]) or limit
+local ts = tonumber(state[2]) or now
+tokens = math.min(limit, tokens + (now - ts) * limit / period)
+
+if tokens < 1 then
+    return {0, 0, math.ceil((1 - tokens) * period / limit)}
+end
+
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call(
+    "HSET", key,
+    "tokens", string.format("%.6f", tokens),
+    "ts", string.format("%.3f", now)
+)
+redis.call("PEXPIRE", key, period)
+return {granted, math.floor(tokens), 0}
+"""
+
+# Приближённое скользящее окно: счётчики текущего и предыдущего
+# фиксированных окон, предыдущий учитывается с весом по доле перекрытия
+SLIDING_WINDOW_COUNTER_SCRIPT = """
+local key = KEYS[1]
+local period = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+
+local time = redis.call("TIME")
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+
+local current = math.floor(now / period)
+local elapsed = now - current * period
+local counts = redis.call("HMGET", key, current, current - 1)
+local cur = tonumber(counts[1]) or 0
+local prev = tonumber(counts[2]) or 0
+local estimated = prev * (1 - elapsed / period) + cur
+
+if estimated + 1 > limit then
+    if cur + 1 > limit or prev == 0 then
+        return {0, 0, period - elapsed}
+    end
+    local weight = (limit - cur - 1) / prev
+    return {0, 0, math.ceil(period * (1 - weight) - elapsed)}
+end
+
+if cur == 0 then
+    -- Новое окно: удаляем счётчики старше предыдущего
+    for _, field in ipairs(redis.call("HKEYS", key)) do
+        if tonumber(field) < current - 1 then
+            redis.call("HDEL", key, field)
+        end
+    end
+end
+
+redis.call("HINCRBY", key, current, 1)
+redis.call("PEXPIRE", key, period * 2)
+return {1, math.floor(limit - estimated - 1), 0}
+"""
+
+
+def _result(response) -> RateLimitResult:
+    allowed, remaining, retry_after = response
+    return RateLimitResult(bool(allowed), remaining, retry_after / 1000)
+
+
 class RateLimiter:
+    # Лог запросов в sorted set: точный, но хранит max_requests записей на ключ
+    SCRIPT = SLIDING_WINDOW_SCRIPT
+
     def __init__(
         self,
         name="rate_limiter",
@@ -17,23 +162,222 @@ class RateLimiter:
         host="localhost",
         port=6379,
         db=0,
+        connection_pool=None,
     ):
-        self.r = redis.Redis(host=host, port=port, db=db, decode_responses=True)
+        self.r = self._client(host, port, db, connection_pool)
         self.name = name
         self.max_requests = max_requests
         self.window = window
+        # Script вызывает EVALSHA и загружает скрипт только при NOSCRIPT
+        self.script = self.r.register_script(self.SCRIPT)
+
+    def _client(self, host, port, db, connection_pool):
+        # Несколько лимитеров могут делить один пул соединений
+        return redis.Redis(
+            host=host,
+            port=port,
+            db=db,
+            decode_responses=True,
+            connection_pool=connection_pool,
+        )
+
+    def _args(self, max_requests, window) -> list:
+        # Уникальный member нужен только логу в sorted set, остальные
+        # скрипты его игнорируют
+        return [int(window * 1000), max_requests, uuid4().hex]
+
+    def _layers(self, keys):
+        # Ключ - либо имя с лимитами лимитера, либо (имя, max_requests, window)
+        for key in keys:
+            if isinstance(key, str):
+                yield key, self.max_requests, self.window
+            else:
+                yield key
+
+    def check(self) -> RateLimitResult:
+        return _result(
+            self.script(
+                keys=[self.name], args=self._args(self.max_requests, self.window)
+            )
+        )
 
     def test(self) -> bool:
-        now = time.time()
-        self.r.zremrangebyscore(self.name, 0, now - self.window)
-        requests_num = self.r.zcard(self.name)
+        return self.check().allowed
+
+    def check_many(self, keys) -> list[RateLimitResult]:
+        # Все проверки - один пайплайн, то есть один round trip. Проверки
+        # независимы: разрешённый слой расходует квоту, даже если другой
+        # слой запрос отклонил
+        pipe = self.r.pipeline(transaction=False)
+        for key, max_requests, window in self._layers(keys):
+            self.script(keys=[key], args=self._args(max_requests, window), client=pipe)
+        return [_result(response) for response in pipe.execute()]
 
-        if requests_num >= self.max_requests:
-            return False
+    def test_many(self, keys) -> bool:
+        return all(result.allowed for result in self.check_many(keys))
 
-        self.r.zadd(self.name, {str(now): now})
 
-        return True
+class GCRARateLimiter(RateLimiter):
+    SCRIPT = GCRA_SCRIPT
+
+
+class TokenBucketRateLimiter(RateLimiter):
+    SCRIPT = TOKEN_BUCKET_SCRIPT
+
+
+class SlidingWindowCounterRateLimiter(RateLimiter):
+    SCRIPT = SLIDING_WINDOW_COUNTER_SCRIPT
+
+
+class _Lease:
+    # Локальный остаток токенов, арендованных у одного ключа в Redis
+    def __init__(self, chunk_size: int, ttl: float):
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.tokens = 0
+        self.expires_at = 0.0
+        self.denied_until = 0.0
+
+    def take(self, now: float) -> RateLimitResult | None:
+        # Ответ без Redis или None, если нужна новая аренда
+        if self.tokens and now < self.expires_at:
+            self.tokens -= 1
+            return RateLimitResult(True, self.tokens, 0.0)
+        if now < self.denied_until:
+            # Пока Redis не выдаст новых токенов, отказываем локально
+            return RateLimitResult(False, 0, self.denied_until - now)
+        return None
+
+    def refill(self, now: float, response) -> RateLimitResult:
+        granted, _, retry_after = response
+        if not granted:
+            self.denied_until = now + retry_after / 1000
+            return RateLimitResult(False, 0, retry_after / 1000)
+        # Другой поток мог арендовать у того же ключа одновременно с нами:
+        # его неистёкшие токены остаются
+        if now >= self.expires_at:
+            self.tokens = 0
+        self.tokens += granted - 1
+        self.expires_at = now + self.ttl
+        return RateLimitResult(True, self.tokens, 0.0)
+
+    def idle(self, now: float) -> bool:
+        # Ни токенов, ни отказа: такая аренда не отличается от новой
+        return now >= self.expires_at and now >= self.denied_until
+
+
+class HybridRateLimiter(TokenBucketRateLimiter):
+    # Процесс арендует у общего token bucket в Redis пачку из chunk_size
+    # токенов и тратит её локально, обращаясь в Redis раз в chunk_size
+    # запросов. Глобальный лимит не превышается никогда: токены выдаёт
+    # Redis. Недобор ограничен: неиспользованные за lease_ttl токены
+    # сгорают, то есть каждый процесс может потерять до chunk_size - 1
+    # токенов за lease_ttl. Аренда своя у каждого ключа check_many(): по
+    # умолчанию chunk_size - десятая часть лимита ключа, lease_ttl - окна
+    SWEEP_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        name="rate_limiter",
+        max_requests=5,
+        window=3,
+        chunk_size=None,
+        lease_ttl=None,
+        **kwargs,
+    ):
+        super().__init__(name, max_requests, window, **kwargs)
+        self.chunk_size = chunk_size
+        self.lease_ttl = lease_ttl
+        # (ключ, max_requests, window) -> аренда. Истёкшие аренды раз в
+        # SWEEP_INTERVAL удаляются, иначе словарь рос бы с каждым
+        # пользователем и IP
+        self.leases: dict[tuple, _Lease] = {}
+        self.lock = threading.Lock()
+        self._sweep_at = 0.0
+
+    def _lease(self, key, max_requests, window) -> _Lease:
+        lease = self.leases.get((key, max_requests, window))
+        if lease is None:
+            lease = self.leases[key, max_requests, window] = _Lease(
+                self.chunk_size or max(1, max_requests // 10),
+                self.lease_ttl if self.lease_ttl is not None else window / 10,
+            )
+        return lease
+
+    def _sweep(self, now: float) -> None:
+        if now < self._sweep_at:
+            return
+        self._sweep_at = now + self.SWEEP_INTERVAL
+        for layer in [layer for layer, lease in self.leases.items() if lease.idle(now)]:
+            del self.leases[layer]
+
+    def check(self) -> RateLimitResult:
+        return self.check_many([self.name])[0]
+
+    def check_many(self, keys) -> list[RateLimitResult]:
+        # Ключи с живой арендой отвечают локально, остальные арендуют новую
+        # пачку одним пайплайном. Пайплайн идёт без замка: потоки, которым
+        # хватает локальных токенов, не ждут чужой round trip
+        with self.lock:
+            now = time.monotonic()
+            self._sweep(now)
+            results, refills = [], []
+            for layer in self._layers(keys):
+                lease = self._lease(*layer)
+                result = lease.take(now)
+                if result is None:
+                    refills.append((len(results), layer, lease.chunk_size))
+                results.append(result)
+
+        if not refills:
+            return results
+
+        pipe = self.r.pipeline(transaction=False)
+        for _, (key, max_requests, window), chunk_size in refills:
+            args = [int(window * 1000), max_requests, "", chunk_size]
+            self.script(keys=[key], args=args, client=pipe)
+        responses = pipe.execute()
+
+        with self.lock:
+            now = time.monotonic()
+            for (i, layer, _), response in zip(refills, responses):
+                # За время запроса аренду могли удалить и создать заново
+                results[i] = self._lease(*layer).refill(now, response)
+        return results
+
+
+class AsyncRateLimiter(RateLimiter):
+    # Те же скрипты поверх redis.asyncio, чтобы не блокировать event loop.
+    # Алгоритм выбирается так же, через SCRIPT
+    def _client(self, host, port, db, connection_pool):
+        return redis.asyncio.Redis(
+            host=host,
+            port=port,
+            db=db,
+            decode_responses=True,
+            connection_pool=connection_pool,
+        )
+
+    async def check(self) -> RateLimitResult:
+        return _result(
+            await self.script(
+                keys=[self.name], args=self._args(self.max_requests, self.window)
+            )
+        )
+
+    async def test(self) -> bool:
+        return (await self.check()).allowed
+
+    async def check_many(self, keys) -> list[RateLimitResult]:
+        async with self.r.pipeline(transaction=False) as pipe:
+            for key, max_requests, window in self._layers(keys):
+                await self.script(
+                    keys=[key], args=self._args(max_requests, window), client=pipe
+                )
+            return [_result(response) for response in await pipe.execute()]
+
+    async def test_many(self, keys) -> bool:
+        return all(result.allowed for result in await self.check_many(keys))
 
 
 def make_api_request(rate_limiter: RateLimiter):
@@ -44,7 +388,166 @@ def make_api_request(rate_limiter: RateLimiter):
         pass
 
 
+ALGORITHMS = [
+    RateLimiter,
+    GCRARateLimiter,
+    TokenBucketRateLimiter,
+    SlidingWindowCounterRateLimiter,
+    HybridRateLimiter,
+]
+
+
+def benchmark_algorithms(max_requests=1000, window=60, n=5000):
+    for algorithm in ALGORITHMS:
+        limiter = algorithm(
+            name=f"rate_limiter_bench:{algorithm.__name__}",
+            max_requests=max_requests,
+            window=window,
+        )
+        limiter.r.delete(limiter.name)
+
+        start = time.perf_counter()
+        for _ in range(n):
+            limiter.test()
+        elapsed = time.perf_counter() - start
+
+        memory = limiter.r.memory_usage(limiter.name)
+        limiter.r.delete(limiter.name)
+        print(
+            f"{algorithm.__name__:<32} {n / elapsed:8.0f} ops/s  "
+            f"{memory:>7} bytes per key (max_requests={max_requests})"
+        )
+
+
 if __name__ == "__main__":
+    limiter = RateLimiter(name="rate_limiter_test", max_requests=5, window=1)
+    limiter.r.delete(limiter.name)
+
+    results = [limiter.check() for _ in range(6)]
+    assert [result.allowed for result in results] == [True] * 5 + [False]
+    assert results[0].remaining == 4 and results[4].remaining == 0
+    assert 0 < results[5].retry_after <= 1
+    assert 0 < limiter.r.pttl(limiter.name) <= 1000
+
+    # Под конкурентной нагрузкой лимит не превышается
+    limiter = RateLimiter(name="rate_limiter_test", max_requests=50, window=10)
+    limiter.r.delete(limiter.name)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        allowed = sum(executor.map(lambda _: limiter.test(), range(500)))
+    assert allowed == 50
+    limiter.r.delete(limiter.name)
+
+    for algorithm in ALGORITHMS:
+        limiter = algorithm(name="rate_limiter_test", max_requests=5, window=0.5)
+        limiter.r.delete(limiter.name)
+        results = [limiter.check() for _ in range(6)]
+        assert [result.allowed for result in results] == [True] * 5 + [False]
+        assert 0 < results[5].retry_after <= 0.5
+        # Через два окна счётчик предыдущего окна тоже обнуляется
+        time.sleep(1)
+        assert limiter.test()
+        limiter.r.delete(limiter.name)
+
+    # Гибридный режим: 100 проверок - 10 обращений к Redis, а три процесса
+    # (здесь - три экземпляра) вместе не превышают общий лимит
+    limiters = [
+        HybridRateLimiter(
+            name="rate_limiter_test", max_requests=100, window=60, chunk_size=10
+        )
+        for _ in range(3)
+    ]
+    limiters[0].r.delete("rate_limiter_test")
+    calls = 0
+    script = limiters[0].script
+
+    def counting_script(*args, **kwargs):
+        global calls
+        calls += 1
+        return script(*args, **kwargs)
+
+    for limiter in limiters:
+        limiter.script = counting_script
+    assert sum(limiters[i % 3].test() for i in range(300)) == 100
+    assert calls == 10 + 3
+    limiters[0].r.delete("rate_limiter_test")
+
+    # Многоуровневый лимит (пользователь, IP, глобальный) за один round trip
+    layers = [
+        ("rate_limiter_test:user", 2, 10),
+        ("rate_limiter_test:ip", 3, 10),
+        ("rate_limiter_test:global", 100, 10),
+    ]
+    limiter = GCRARateLimiter()
+    limiter.r.delete(*(key for key, _, _ in layers))
+    assert [limiter.test_many(layers) for _ in range(3)] == [True, True, False]
+    assert [r.allowed for r in limiter.check_many(layers)] == [False, False, True]
+    limiter.r.delete(*(key for key, _, _ in layers))
+
+    # Гибридный лимитер арендует токены у каждого слоя отдельно
+    calls = 0
+    hybrid = HybridRateLimiter(
+        name="rate_limiter_test:global", max_requests=100, window=10
+    )
+    script = hybrid.script
+    hybrid.script = counting_script
+    results = [hybrid.check_many(layers) for _ in range(4)]
+    assert [all(r.allowed for r in layer) for layer in results] == [
+        True,
+        True,
+        False,
+        False,
+    ]
+    assert [r.allowed for r in results[3]] == [False, False, True]
+    # Первая проверка арендует у всех трёх ключей; у user и ip пачка - один
+    # токен, а global (10 токенов) дальше отвечает локально
+    assert calls == 3 + 2 + 2 + 1
+    assert hybrid.test()
+
+    # Пока один поток ждёт аренду из Redis, другой отвечает из своей
+    def slow_script(*args, **kwargs):
+        time.sleep(0.3)
+        return script(*args, **kwargs)
+
+    hybrid.script = slow_script
+    with ThreadPoolExecutor() as executor:
+        refill = executor.submit(hybrid.check_many, ["rate_limiter_test:slow"])
+        time.sleep(0.05)
+        start = time.perf_counter()
+        assert hybrid.test()
+        assert time.perf_counter() - start < 0.1
+        assert refill.result()[0].allowed
+    hybrid.script = script
+
+    # Истёкшие аренды по пользователям не копятся
+    hybrid = HybridRateLimiter(name="rate_limiter_test:global", lease_ttl=0.05)
+    hybrid.SWEEP_INTERVAL = 0
+    users = [(f"rate_limiter_test:user:{i}", 10, 10) for i in range(50)]
+    assert all(r.allowed for r in hybrid.check_many(users))
+    time.sleep(0.1)
+    assert hybrid.test()
+    assert list(hybrid.leases) == [("rate_limiter_test:global", 5, 3)]
+    hybrid.r.delete("rate_limiter_test:slow", *(key for key, _, _ in users))
+
+    async def check_async():
+        pool = redis.asyncio.ConnectionPool(decode_responses=True)
+        limiters = [
+            AsyncRateLimiter(name=key, max_requests=n, window=w, connection_pool=pool)
+            for key, n, w in layers
+        ]
+        await limiters[0].r.delete(*(key for key, _, _ in layers))
+
+        assert [await limiters[0].test() for _ in range(3)] == [True, True, False]
+        results = await limiters[1].check_many(layers)
+        assert [r.allowed for r in results] == [False, True, True]
+
+        await limiters[0].r.delete(*(key for key, _, _ in layers))
+        await pool.aclose()
+
+    asyncio.run(check_async())
+    limiter.r.delete(*(key for key, _, _ in layers))
+
+    benchmark_algorithms()
+
     rate_limiter = RateLimiter()
 
     for _ in range(50):